@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import asyncio
+import time
+import sqlite3
+import argparse
+
+import util
+import config
+import shards
+
+# Online backup and per-guild JSONL export/import of bot_data.db (and the shard files, with
+# db_shards). Everything here is blocking sqlite3, the bot runs it with asyncio.to_thread (see
+# commands/owner.py).
+
+backup_dir = config.get("backup_dir", util.path + "backups/")
+# pages copied per backup step, the source is unlocked between steps so the bot can keep writing
+backup_pages = 256
+backup_sleep = 0.005
+import_batch = 500
+export_version = 1
+
+def db_path():
+    return util.path + "bot_data.db"
+
+def stamp():
+    return time.strftime("%Y%m%d-%H%M%S")
+
+def copy_db(src: str, dest: str):
+    source = sqlite3.connect(src)
+    target = sqlite3.connect(dest)
+    try:
+        source.backup(target, pages=backup_pages, sleep=backup_sleep)
+    finally:
+        target.close()
+        source.close()
+    return os.path.getsize(dest)
+
+def backup(dest: str = None, src: str = None):
+    # consistent copy of a live database, returns (path, size in bytes). With db_shards (and no
+    # src) dest is a folder with bot_data.db and every shard file, each copied on its own
+    if src is not None or not shards.enabled():
+        if dest is None:
+            os.makedirs(backup_dir, exist_ok=True)
+            dest = os.path.join(backup_dir, f"bot_data-{stamp()}.db")
+        return dest, copy_db(src or db_path(), dest)
+    if dest is None:
+        dest = os.path.join(backup_dir, f"bot_data-{stamp()}")
+    os.makedirs(os.path.join(dest, "shards"), exist_ok=True)
+    size = copy_db(db_path(), os.path.join(dest, "bot_data.db"))
+    for file_path in shards.guild_paths():
+        size += copy_db(file_path, os.path.join(dest, "shards", shards.shard_name(file_path)))
+    return dest, size
+
+def rows_as_dicts(cursor: sqlite3.Cursor):
+    names = [d[0] for d in cursor.description]
+    for row in cursor:
+        yield dict(zip(names, row))
+
+def export(out, guild: int = None, src: str = None):
+    # writes one json object per line to `out`: a header, then every user and challenge row.
+    # rows are streamed from the cursor, so memory use doesn't grow with the guild
+    if src is not None:
+        sources = [src]
+    elif guild is not None:
+        sources = [shards.guild_path(guild)]
+    else:
+        sources = shards.guild_paths()
+    counts = {"user": 0, "challenge": 0}
+    out.write(json.dumps({"type": "export", "version": export_version, "guild": guild, "time": int(time.time())}) + "\n")
+    where, params = ("WHERE server_id = ?", (guild,)) if guild is not None else ("", ())
+    for file_path in sources:
+        if not os.path.exists(file_path):
+            continue
+        conn = sqlite3.connect(file_path)
+        try:
+            for kind, query in (
+                ("user", f"SELECT * FROM users {where} ORDER BY server_id, user_id"),
+                ("challenge", f"SELECT * FROM challenges {where} ORDER BY server_id, user_id, seq")
+            ):
+                for row in rows_as_dicts(conn.execute(query, params)):
+                    row["type"] = kind
+                    out.write(json.dumps(row, separators=(",", ":")) + "\n")
+                    counts[kind] += 1
+        finally:
+            conn.close()
+    return counts
+
+def export_file(guild: int = None, dest: str = None, src: str = None):
+    if dest is None:
+        os.makedirs(backup_dir, exist_ok=True)
+        dest = os.path.join(backup_dir, f"export-{guild if guild is not None else 'all'}-{stamp()}.jsonl")
+    with open(dest, "w", encoding="utf-8") as out:
+        counts = export(out, guild, src)
+    return dest, counts
+
+def table_columns(conn: sqlite3.Connection, table: str):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+def import_lines(lines, guild: int = None, replace: bool = False, dest: str = None):
+    # reads what export() wrote, in batches. guild moves every row to that server id (migrations),
+    # replace deletes the target guild's rows first. Needs a database the bot has created already.
+    # With db_shards (and no dest) every row goes to its guild's shard file
+    sharded = dest is None and shards.enabled()
+    conns: dict[str, sqlite3.Connection] = {}
+    columns = {}
+    counts = {"user": 0, "challenge": 0}
+    tables = {"user": "users", "challenge": "challenges"}
+    batches = {}
+    handles = set()
+    cleared = set()
+
+    def conn_for(server_id: int):
+        file_path = shards.guild_path(server_id) if sharded else dest or db_path()
+        if file_path not in conns:
+            if sharded and not os.path.exists(file_path):
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                asyncio.run(shards.create_guild_file(file_path))
+            conn = sqlite3.connect(file_path)
+            columns[file_path] = {"user": table_columns(conn, "users"), "challenge": table_columns(conn, "challenges")}
+            if not columns[file_path]["user"] or not columns[file_path]["challenge"]:
+                conn.close()
+                raise RuntimeError("target database has no tables, start the bot once to create them")
+            conn.execute("BEGIN")
+            conns[file_path] = conn
+        return file_path, conns[file_path]
+
+    def flush(file_path: str, kind: str):
+        batch = batches.get((file_path, kind))
+        if not batch:
+            return
+        names = [c for c in columns[file_path][kind] if c in batch[0]]
+        conns[file_path].executemany(
+            f"INSERT OR REPLACE INTO {tables[kind]} ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})",
+            [tuple(row.get(c) for c in names) for row in batch]
+        )
+        counts[kind] += len(batch)
+        batch.clear()
+
+    try:
+        if not sharded:
+            conn_for(0)
+        for line in lines:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            kind = row.pop("type", None)
+            if kind == "export":
+                if row.get("version") != export_version:
+                    raise RuntimeError(f"unsupported export version {row.get('version')}")
+                continue
+            if kind not in tables:
+                continue
+            if guild is not None:
+                row["server_id"] = guild
+            file_path, conn = conn_for(row["server_id"])
+            if replace and row["server_id"] not in cleared:
+                # handles that leave the guild need their global rows recomputed as well
+                handles.update(h for (h,) in conn.execute("SELECT handle FROM users WHERE server_id = ?", (row["server_id"],)))
+                conn.execute("DELETE FROM users WHERE server_id = ?", (row["server_id"],))
+                conn.execute("DELETE FROM challenges WHERE server_id = ?", (row["server_id"],))
+                cleared.add(row["server_id"])
+            if kind == "user":
+                handles.add(row["handle"])
+            batch = batches.setdefault((file_path, kind), [])
+            batch.append(row)
+            if len(batch) >= import_batch:
+                flush(file_path, kind)
+        for file_path, kind in list(batches):
+            flush(file_path, kind)
+        if not sharded:
+            conn = next(iter(conns.values()))
+            for handle in handles:
+                conn.execute("DELETE FROM global_handles WHERE handle = ?", (handle,))
+                conn.execute(f"INSERT INTO global_handles {util.global_handle_select} WHERE handle = ? GROUP BY handle", (handle,))
+        for conn in conns.values():
+            conn.commit()
+    except Exception:
+        for conn in conns.values():
+            conn.rollback()
+        raise
+    finally:
+        for conn in conns.values():
+            conn.close()
+    if sharded and conns:
+        # the global rows are spread over every shard, rebuilt in one go
+        shards.rebuild_global()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Back up, export or import bot_data.db")
+    parser.add_argument("--db", default=None, help="database to use (default: bot_data.db next to this file, and the shard files with db_shards)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("backup", help="online copy of the database, safe while the bot runs")
+    p.add_argument("dest", nargs="?", default=None)
+    p = sub.add_parser("export", help="users and challenges as JSONL")
+    p.add_argument("--guild", type=int, default=None, help="only this server (default: all)")
+    p.add_argument("dest", nargs="?", default=None, help="output file, - for stdout")
+    p = sub.add_parser("import", help="load a JSONL export (stop the bot first, it caches rankings)")
+    p.add_argument("src", help="export file, - for stdin")
+    p.add_argument("--guild", type=int, default=None, help="put every row in this server instead")
+    p.add_argument("--replace", action="store_true", help="delete the server's existing rows first")
+    args = parser.parse_args()
+
+    if args.command == "backup":
+        dest, size = backup(args.dest, args.db)
+        print(f"wrote {dest} ({size / 1e6:.1f} MB)")
+    elif args.command == "export":
+        if args.dest == "-":
+            export(sys.stdout, args.guild, args.db)
+        else:
+            dest, counts = export_file(args.guild, args.dest, args.db)
+            print(f"wrote {dest} ({counts['user']} users, {counts['challenge']} challenges)")
+    else:
+        if args.src == "-":
+            counts = import_lines(sys.stdin, args.guild, args.replace, args.db)
+        else:
+            with open(args.src, encoding="utf-8") as f:
+                counts = import_lines(f, args.guild, args.replace, args.db)
+        print(f"imported {counts['user']} users, {counts['challenge']} challenges")
+
+if __name__ == "__main__":
+    main()
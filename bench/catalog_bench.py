@@ -0,0 +1,63 @@
+import os
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import util
+import proxy
+from fake_cf import make_problems
+
+# Resident memory of the problem catalog against the list of dicts plus id -> dict index it
+# replaced, both built the way a refresh does it: from a decoded problemset.problems response.
+
+def legacy(problems: list):
+    rated = [p for p in problems if p["rating"] is not None]
+    return rated, {str(p["contestId"]) + p["index"]: p for p in rated}
+
+def retained(build, body: str):
+    # bytes still allocated after building from a freshly decoded response and dropping the response
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    problems = proxy.extract_problems(json.loads(body)["result"])
+    kept = build(problems)
+    del problems
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    # timed again without tracemalloc, it slows allocations down a lot
+    problems = proxy.extract_problems(json.loads(body)["result"])
+    t = time.perf_counter()
+    build(problems)
+    return kept, size, time.perf_counter() - t
+
+def lookups(fn, ids: list):
+    t = time.perf_counter()
+    for pid in ids:
+        fn(pid)
+    return (time.perf_counter() - t) / len(ids) * 1e9
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory of the problem catalog against the old list + dict")
+    parser.add_argument("--problems", type=int, default=10000)
+    args = parser.parse_args()
+
+    body = json.dumps({"status": "OK", "result": {"problems": make_problems(args.problems), "problemStatistics": []}})
+    (rated, by_id), old_size, old_time = retained(legacy, body)
+    catalog, new_size, new_time = retained(lambda problems: util.ProblemCatalog([p for p in problems if p["rating"] is not None]), body)
+
+    ids = random.Random(1).choices(catalog.ids, k=100_000)
+    print(f"{len(catalog)} rated problems of {args.problems}")
+    print(f"list + dict: {old_size / 1e6:.2f} MB ({old_size / len(catalog):.0f} bytes per problem), built in {old_time * 1000:.1f} ms")
+    print(f"catalog:     {new_size / 1e6:.2f} MB ({new_size / len(catalog):.0f} bytes per problem), built in {new_time * 1000:.1f} ms")
+    print(f"rating lookup: dict {lookups(lambda pid: by_id[pid]['rating'], ids):.0f} ns, catalog {lookups(catalog.rating, ids):.0f} ns")
+    print(f"full problem:  dict {lookups(by_id.__getitem__, ids):.0f} ns, catalog {lookups(catalog.__getitem__, ids):.0f} ns")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import util
+util.path = tempfile.mkdtemp(prefix="challenge_bench_") + "/"
+import shards
+# shard files (if db_shards is on) go in the temporary folder too
+shards.shard_dir = None
+
+import main
+import proxy
+import settlement
+import challenge_engine
+from fake_cf import make_problems
+
+# Runs many simulated challenges through one ChallengeEngine on a simulated clock: whenever the
+# engine would sleep, the clock jumps to its next timer once all in-flight work is done. Polls
+# and renders are fakes, ratings are settled into a throwaway database.
+
+class SimClock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+class SimEngine(challenge_engine.ChallengeEngine):
+    peak_tasks = 0
+    peak_timers = 0
+
+    async def idle(self, delay: float):
+        self.peak_tasks = max(self.peak_tasks, len(self.tasks))
+        self.peak_timers = max(self.peak_timers, len(self.heap))
+        while self.tasks:
+            await asyncio.wait(list(self.tasks))
+        if self.heap and self.heap[0][0] > self.clock.now:
+            self.clock.now = self.heap[0][0]
+
+class FakeEgg:
+    # handle -> time of its accepted submission (None if it never solves)
+    def __init__(self, clock: SimClock, problem: str):
+        self.clock = clock
+        self.problem = problem
+        self.solve_at = {}
+        self.in_flight = {}
+        self.max_in_flight = 0
+        self.polls = 0
+
+    async def extract(self, name, endpoint, params=None, **kwargs):
+        handle = params["handle"]
+        self.polls += 1
+        self.in_flight[handle] = self.in_flight.get(handle, 0) + 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight[handle])
+        await asyncio.sleep(0)
+        self.in_flight[handle] -= 1
+        t = self.solve_at.get(handle)
+        if t is not None and t <= self.clock.now:
+            return [(1, int(t), self.problem, "OK")]
+        return []
+
+    async def breaker_state(self, endpoint=None):
+        return "closed"
+
+class CountingView:
+    renders = 0
+    results = 0
+
+    async def update(self, ch):
+        CountingView.renders += 1
+        if ch.state == "settled":
+            CountingView.results += 1
+
+    async def failed(self, ch):
+        pass
+
+async def run(count: int, seed: int):
+    rng = random.Random(seed)
+    problems = proxy.extract_problems({"problems": make_problems(200)})
+    util.apply_problems(problems)
+    problem = next(pid for pid in util.catalog.ids if util.catalog.rating(pid) == 1600)
+
+    await main.init_database()
+    clock = SimClock()
+    egg = FakeEgg(clock, problem)
+    engine = SimEngine(egg, clock)
+    # no point waiting for more updates, simulated time stands still while the batch is open
+    settlement.settlement_queue.window = 0.0
+
+    rows = []
+    challenges = []
+    for i in range(count):
+        users = list(range(rng.randint(1, 5)))
+        length = rng.choice((40, 60, 80))
+        ch = challenge_engine.LiveChallenge(i, users, problem, length, CountingView())
+        ch.handles = [f"h{i}_{u}" for u in users]
+        start = clock.now + rng.uniform(0, 600)
+        for handle in ch.handles:
+            if rng.random() < 0.6:
+                egg.solve_at[handle] = start + rng.uniform(60, length * 60)
+        rows.extend((i, u, h, 1500) for u, h in zip(users, ch.handles))
+        challenges.append((start, ch))
+    by_file = {}
+    for row in rows:
+        by_file.setdefault(shards.guild_path(row[0]), []).append(row)
+    for file_path, file_rows in by_file.items():
+        await shards.ensure_guild_file(file_path)
+        conn = sqlite3.connect(file_path)
+        conn.executemany("INSERT INTO users (server_id, user_id, handle, rating) VALUES (?, ?, ?, ?)", file_rows)
+        conn.commit()
+        conn.close()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for start, ch in challenges:
+        engine.at(start, engine.start, ch)
+    after = tracemalloc.get_traced_memory()[0]
+
+    t = time.perf_counter()
+    while True:
+        if engine.runner is not None and not engine.runner.done():
+            await engine.runner
+        elif engine.tasks:
+            await asyncio.wait(list(engine.tasks))
+        else:
+            break
+    elapsed = time.perf_counter() - t
+    tracemalloc.stop()
+
+    participants = sum(len(ch.users) for _, ch in challenges)
+    settled = sum(ch.state == "settled" for _, ch in challenges)
+    simulated = clock.now - min(start for start, _ in challenges)
+    # the per-challenge loop kept one check_ac task per 10s tick until the challenge ended
+    legacy_tasks = sum(ch.length * 6 for _, ch in challenges)
+
+    print(f"{count} challenges, {participants} participants, {simulated / 60:.0f} simulated minutes in {elapsed:.1f}s")
+    print(f"settled: {settled}, solved: {sum(ch.solved.count(1) for _, ch in challenges)}, renders: {CountingView.renders}")
+    print(f"polls: {egg.polls}, most polls in flight for one handle: {egg.max_in_flight}")
+    print(f"peak in-flight polls/renders: {engine.peak_tasks}, peak timers: {engine.peak_timers} (the old loop kept up to {legacy_tasks} check_ac tasks alive)")
+    print(f"scheduling memory: {(after - before) / count:.0f} bytes per challenge")
+
+def main_():
+    parser = argparse.ArgumentParser(description="Simulated concurrent challenges through the challenge engine")
+    parser.add_argument("--challenges", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(run(args.challenges, args.seed))
+
+if __name__ == "__main__":
+    main_()
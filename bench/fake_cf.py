@@ -0,0 +1,108 @@
+import gzip
+import json
+import random
+import asyncio
+from aiohttp import web
+
+# A local stand-in for the Codeforces API with synthetic data, for the benchmarks in this folder.
+# It counts the connections it accepts and the body bytes it sends.
+
+tags = ["dp", "greedy", "math", "graphs", "implementation", "brute force", "strings", "trees",
+        "binary search", "sortings", "constructive algorithms", "number theory", "data structures"]
+
+def make_problems(count: int, seed: int = 1):
+    rng = random.Random(seed)
+    problems = []
+    contest = 1
+    while len(problems) < count:
+        for index in "ABCDEF":
+            p = {
+                "contestId": contest,
+                "index": index,
+                "name": f"Problem {contest}{index}",
+                "type": "PROGRAMMING",
+                "points": 500.0,
+                "tags": rng.sample(tags, rng.randint(1, 4))
+            }
+            if rng.random() < 0.9:
+                p["rating"] = rng.randrange(800, 3600, 100)
+            problems.append(p)
+        contest += 1
+    return problems[:count]
+
+def make_submissions(problems: list, count: int, seed: int = 2, start_id: int = 1):
+    rng = random.Random(seed)
+    subs = []
+    for i in range(count):
+        p = rng.choice(problems)
+        subs.append({
+            "id": start_id + count - i,
+            "contestId": p["contestId"],
+            "creationTimeSeconds": 1700000000 - i * 60,
+            "problem": {"contestId": p["contestId"], "index": p["index"], "name": p["name"], "tags": p["tags"]},
+            "author": {"members": [{"handle": "egg"}]},
+            "programmingLanguage": "C++17",
+            "verdict": rng.choice(["OK", "WRONG_ANSWER", "OK", "TIME_LIMIT_EXCEEDED"]),
+            "testset": "TESTS",
+            "passedTestCount": 10,
+            "timeConsumedMillis": 31,
+            "memoryConsumedBytes": 0
+        })
+    return subs
+
+class FakeCF:
+    def __init__(self, problem_count: int = 10000, latency: float = 0.0):
+        self.problems = make_problems(problem_count)
+        self.submissions = make_submissions(self.problems, 20000)
+        self.latency = latency
+        self.connections = set()
+        self.requests = 0
+        self.body_bytes = 0
+        self.runner = None
+        self.port = None
+
+    def reset_counters(self):
+        self.connections = set()
+        self.requests = 0
+        self.body_bytes = 0
+
+    def respond(self, request: web.Request, result) -> web.Response:
+        self.requests += 1
+        self.connections.add(request.transport.get_extra_info("peername"))
+        body = json.dumps({"status": "OK", "result": result}).encode()
+        headers = {"Content-Type": "application/json"}
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+        self.body_bytes += len(body)
+        return web.Response(body=body, headers=headers)
+
+    async def handle(self, request: web.Request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        method = request.match_info["method"]
+        q = request.query
+        if method == "problemset.problems":
+            return self.respond(request, {"problems": self.problems, "problemStatistics": []})
+        if method == "user.status":
+            start = int(q.get("from", 1)) - 1
+            return self.respond(request, self.submissions[start:start + int(q.get("count", 100))])
+        if method == "contest.status":
+            subs = [s for s in self.submissions[:2000] if str(s["contestId"]) == q.get("contestId")]
+            return self.respond(request, subs[:int(q.get("count", 100))])
+        if method == "user.info":
+            return self.respond(request, [{"handle": h} for h in q.get("handles", "").split(";")])
+        return self.respond(request, [])
+
+    async def start(self, port: int = 0):
+        app = web.Application()
+        app.router.add_get("/api/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{self.port}/api/"
+
+    async def stop(self):
+        await self.runner.cleanup()
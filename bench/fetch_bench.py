@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import proxy
+from fake_cf import FakeCF
+
+# Sends the same request mix through EggFetch with and without the per-dispatcher
+# keep-alive pools and compression, against the local fake server.
+
+mix = [
+    ("contest.status", {"contestId": "5", "asManager": "false", "from": 1, "count": 100, "handle": "egg"}),
+    ("user.status", {"handle": "egg", "from": 1, "count": 100}),
+    ("user.info", {"handles": "egg"}),
+    ("user.status", {"handle": "egg", "from": 1, "count": 5000}),
+]
+
+async def run(base_url: str, server: FakeCF, requests: int, concurrency: int, legacy: bool):
+    proxy.EggFetch.cf_base_url = base_url
+    proxy.EggFetch.dispatcher_wait = 0.0
+    proxy.EggFetch.force_close = legacy
+    proxy.EggFetch.accept_encoding = "identity" if legacy else "gzip, deflate"
+    egg = proxy.EggFetch()
+    # the bench only has the main dispatcher, let it take `concurrency` requests at once
+    for i in range(1, concurrency):
+        egg.dispatchers[-i] = None
+        egg.pool[-i] = None
+        egg.dispatcher_queue.append(-i)
+    server.reset_counters()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with sem:
+            endpoint, params = mix[i % len(mix)]
+            await egg.codeforces(endpoint, params)
+
+    t = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - t
+    await egg.close()
+    # EggFetch keeps its pool on the class, start the next run clean
+    for i in range(1, concurrency):
+        proxy.EggFetch.dispatchers.pop(-i, None)
+        proxy.EggFetch.pool.pop(-i, None)
+    proxy.EggFetch.dispatcher_queue.clear()
+    proxy.EggFetch.sessions.clear()
+    proxy.EggFetch.health.clear()
+    return elapsed, server.requests, len(server.connections), server.body_bytes
+
+async def main():
+    parser = argparse.ArgumentParser(description="EggFetch transport benchmark against a local fake Codeforces")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    server = FakeCF()
+    base_url = await server.start()
+    try:
+        print(f"{args.requests} requests, {args.concurrency} at a time")
+        print(f"{'mode':<28} {'time s':>8} {'connections':>12} {'MB sent':>9} {'KB/request':>11}")
+        for name, legacy in (("no keep-alive, identity", True), ("keep-alive pool, gzip", False)):
+            elapsed, requests, connections, body = await run(base_url, server, args.requests, args.concurrency, legacy)
+            per_1000 = 1000 / max(requests, 1)
+            print(f"{name:<28} {elapsed:>8.2f} {connections * per_1000:>12.0f} {body * per_1000 / 1e6:>9.1f} {body / max(requests, 1) / 1e3:>11.1f}")
+    finally:
+        await server.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,139 @@
+import logging
+from collections import OrderedDict
+
+import util
+import solved
+
+logger = logging.getLogger("bot_logger.candidates")
+
+class TagIndex:
+    # every rated problem gets a bit position, and each tag and rating maps to an int used as a
+    # bitmap over those positions, so tag filters are a few big-int ands instead of a list scan
+    def __init__(self):
+        self.order: list[str] = []
+        self.tags: dict[str, int] = {}
+        self.ratings: dict[int, int] = {}
+        self.version = -1
+
+    def rebuild(self, changes: list = None):
+        catalog = util.catalog
+        order = sorted(catalog.ids)
+        by_id = [0] * len(catalog.tag_names)
+        ratings: dict[int, int] = {}
+        for i, pid in enumerate(order):
+            row = catalog.rows[pid]
+            bit = 1 << i
+            rating = catalog.ratings[row]
+            ratings[rating] = ratings.get(rating, 0) | bit
+            for t in catalog.tag_ids_of(row):
+                by_id[t] |= bit
+        tags = {name: by_id[t] for t, name in enumerate(catalog.tag_names)}
+        self.order, self.tags, self.ratings = order, tags, ratings
+        self.version = util.problems_version
+
+    def ensure_current(self):
+        # in case the first refresh happened before this module was imported
+        if self.version != util.problems_version:
+            self.rebuild()
+
+    def normalize(self, tag: str):
+        return tag.lower().replace("_", " ")
+
+    def parse(self, text: str):
+        # "dp !greedy binary_search" -> (required, excluded), raises ValueError on unknown tags
+        self.ensure_current()
+        required, excluded, unknown = set(), set(), []
+        for word in text.split():
+            negate = word.startswith("!")
+            tag = self.normalize(word[1:] if negate else word)
+            if tag not in self.tags:
+                unknown.append(word)
+            elif negate:
+                excluded.add(tag)
+            else:
+                required.add(tag)
+        if unknown:
+            raise ValueError(", ".join(unknown))
+        return frozenset(required), frozenset(excluded)
+
+    def mask(self, lo: int, hi: int, required: frozenset = frozenset(), excluded: frozenset = frozenset()):
+        # problems rated lo..hi (inclusive, multiples of 100) with every required tag and no excluded one
+        m = 0
+        for rating in range(lo, hi + 1, 100):
+            m |= self.ratings.get(rating, 0)
+        for tag in required:
+            m &= self.tags.get(tag, 0)
+        for tag in excluded:
+            m &= ~self.tags.get(tag, 0)
+        return m
+
+    def ids(self, mask: int):
+        ret = []
+        while mask:
+            low = mask & -mask
+            ret.append(self.order[low.bit_length() - 1])
+            mask ^= low
+        return ret
+
+index = TagIndex()
+util.problem_listeners.append(index.rebuild)
+
+class CandidateCache:
+    # (handles, lowest rating, highest rating, tag filter) -> problem ids matching it that none of
+    # the handles solved. An entry stays valid until one of its handles gets a new accepted
+    # submission (solved.solve_cursor moves) or a problemset refresh touches a problem it holds
+    # or one whose rating is now in its range
+    def __init__(self, size: int = 256):
+        self.size = size
+        self.entries: OrderedDict[tuple, tuple] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def cursors(self, handles: frozenset):
+        return tuple(solved.solve_cursor.get(h) for h in sorted(handles))
+
+    def still_valid(self, key: tuple, entry: tuple):
+        cursors, version, ids = entry
+        if cursors != self.cursors(key[0]) or None in cursors:
+            return False
+        if version == util.problems_version:
+            return True
+        changes = util.changes_since(version)
+        if changes is None:
+            return False
+        held = set(ids)
+        for _, _, pid in changes:
+            row = util.catalog.rows.get(pid)
+            if pid in held or (row is not None and key[1] <= util.catalog.ratings[row] <= key[2]):
+                return False
+        # nothing relevant changed, carry the entry over to the new version
+        self.entries[key] = (cursors, util.problems_version, ids)
+        return True
+
+    def get(self, key: tuple):
+        entry = self.entries.get(key)
+        if entry is not None and self.still_valid(key, entry):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][2]
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, ids: list):
+        self.entries[key] = (self.cursors(key[0]), util.problems_version, ids)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+cache = CandidateCache()
+
+def unsolved(handles: list, solved_sets: list, lo: int, hi: int, tags: tuple = (frozenset(), frozenset())):
+    # ids of problems rated lo..hi (and with tags) that nobody in the group solved, from the cache when possible
+    key = (frozenset(handles), lo, hi, tags)
+    ids = cache.get(key)
+    if ids is None:
+        index.ensure_current()
+        done = set().union(*solved_sets)
+        ids = [pid for pid in index.ids(index.mask(lo, hi, *tags)) if pid not in done]
+        cache.put(key, ids)
+    return ids
@@ -0,0 +1,305 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import contextvars
+
+import util
+import tracing
+import settlement
+from proxy import CircuitOpen, DeadlineExceeded
+
+logger = logging.getLogger("bot_logger.challenge_engine")
+
+# (user_id, server_id) of everyone in a challenge that isn't settled for them yet
+active_chal = set()
+
+class LiveChallenge:
+    # one =challenge, confirming -> running -> draining -> settled. solved[j] is 0 (still going),
+    # 1 (solved), 2 (gave up or ran out of time) or 3 (quit without a rating change while
+    # codeforces was down). The view renders it (see commands/challenge.py)
+    __slots__ = ("server_id", "users", "handles", "problem", "length", "start", "state", "solved", "ready",
+                 "message_id", "polling", "tick", "changed", "rendering", "cf_down", "drain_until", "view")
+
+    def __init__(self, server_id: int, users: list, problem: str, length: int, view=None):
+        self.server_id = server_id
+        self.users = users
+        self.handles = []
+        self.problem = problem
+        self.length = length
+        self.start = 0.0
+        self.state = "confirming"
+        self.solved = [0] * len(users)
+        # users that reacted with ✅ while confirming
+        self.ready = set()
+        self.message_id = None
+        # participants (by index) with a verdict poll in flight, never more than one each
+        self.polling = set()
+        self.tick = 0
+        self.changed = False
+        self.rendering = False
+        self.cf_down = False
+        self.drain_until = None
+        self.view = view
+
+    @property
+    def ends(self):
+        return self.start + self.length * 60
+
+class ChallengeEngine:
+    # every running challenge is a few timers in one heap, served by a single task, instead of a
+    # coroutine sleeping for the whole challenge. Each tick polls one participant (round robin,
+    # like before) and re-renders every third tick or when something changed
+    poll_interval = 10
+    render_every = 3
+    drain_interval = 20
+    drain_limit = 300
+
+    def __init__(self, egg, clock=time.time):
+        self.egg = egg
+        self.clock = clock
+        self.heap = []
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.runner = None
+        self.tasks = set()
+        self.by_message: dict[int, LiveChallenge] = {}
+        self.cf_down = False
+        self.cf_checked = 0.0
+
+    def at(self, when: float, fn, *args):
+        entry = (when, next(self.seq), fn, args)
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self.wakeup.set()
+        if self.runner is None or self.runner.done():
+            # the runner outlives the command that started it, so it mustn't inherit its trace and log context
+            self.runner = asyncio.create_task(self.run(), context=contextvars.Context())
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro, context=contextvars.Context())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def idle(self, delay: float):
+        # until the earliest timer is due, or an earlier one gets scheduled
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        while self.heap:
+            delay = self.heap[0][0] - self.clock()
+            if delay > 0:
+                await self.idle(delay)
+                continue
+            _, _, fn, args = heapq.heappop(self.heap)
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"Error in challenge timer: {e}")
+
+    def register(self, ch: LiveChallenge, message_id: int):
+        ch.message_id = message_id
+        self.by_message[message_id] = ch
+
+    def forget(self, ch: LiveChallenge):
+        self.by_message.pop(ch.message_id, None)
+
+    def start(self, ch: LiveChallenge):
+        ch.state = "running"
+        ch.start = self.clock()
+        ch.cf_down = self.cf_down
+        for user_id in ch.users:
+            active_chal.add((user_id, ch.server_id))
+        self.at(ch.start, self.on_tick, ch)
+
+    def on_tick(self, ch: LiveChallenge):
+        if ch.state != "running":
+            return
+        if self.clock() - self.cf_checked >= self.poll_interval:
+            self.cf_checked = self.clock()
+            self.spawn(self.check_breaker())
+        if ch.tick * self.poll_interval >= ch.length * 60 or min(ch.solved) >= 1:
+            self.begin_drain(ch)
+            return
+        j = ch.tick % len(ch.users)
+        if ch.solved[j] == 0 and j not in ch.polling:
+            ch.polling.add(j)
+            self.spawn(self.poll(ch, j))
+        if ch.tick % self.render_every == 0 or ch.changed or ch.cf_down != self.cf_down:
+            self.render(ch)
+        ch.tick += 1
+        self.at(ch.start + ch.tick * self.poll_interval, self.on_tick, ch)
+
+    async def check_breaker(self):
+        # one lookup per interval shared by every challenge
+        try:
+            self.cf_down = await self.egg.breaker_state("contest.status") != "closed"
+        except Exception as e:
+            logger.error(f"Error while checking codeforces status: {e}")
+
+    def render(self, ch: LiveChallenge):
+        if ch.view is None:
+            return
+        if ch.rendering:
+            ch.changed = True
+            return
+        ch.rendering = True
+        ch.changed = False
+        ch.cf_down = self.cf_down
+        self.spawn(self.render_now(ch))
+
+    async def render_now(self, ch: LiveChallenge):
+        try:
+            await ch.view.update(ch)
+        except Exception as e:
+            logger.error(f"Error while updating challenge message: {e}")
+        finally:
+            ch.rendering = False
+
+    async def poll(self, ch: LiveChallenge, j: int):
+        try:
+            # past the participant's next turn this poll is stale, so it doesn't hold up the next one
+            if await got_ac(self.egg, ch.handles[j], ch.problem, ch.length, ch.start, budget=self.poll_interval * len(ch.users)):
+                await self.solve(ch, j)
+        except Exception as e:
+            await self.fail(ch, e)
+        finally:
+            ch.polling.discard(j)
+
+    async def solve(self, ch: LiveChallenge, j: int):
+        user_id = ch.users[j]
+        r = await util.get_rating(ch.server_id, user_id)
+        l = util.get_rating_changes(r, util.catalog.rating(ch.problem), ch.length)
+        if ch.solved[j] != 0:
+            return
+        ch.solved[j] = 1
+        ch.changed = True
+        active_chal.discard((user_id, ch.server_id))
+        await update_rating(ch.server_id, user_id, r + l[1], ch.problem, ch.length)
+
+    async def give_up(self, ch: LiveChallenge, user_id: int):
+        logger.info(f"Challenge cancelled by {user_id}")
+        j = ch.users.index(user_id)
+        r = await util.get_rating(ch.server_id, user_id)
+        l = util.get_rating_changes(r, util.catalog.rating(ch.problem), ch.length)
+        if ch.solved[j] == 0 and (user_id, ch.server_id) in active_chal:
+            ch.solved[j] = 2
+            ch.changed = True
+            active_chal.discard((user_id, ch.server_id))
+            await update_rating(ch.server_id, user_id, r + l[0], ch.problem, ch.length)
+
+    def quit(self, ch: LiveChallenge, user_id: int):
+        # only offered while codeforces is down, no rating change
+        logger.info(f"Challenge cancelled by {user_id} (cf down)")
+        j = ch.users.index(user_id)
+        if ch.solved[j] == 0 and (user_id, ch.server_id) in active_chal:
+            ch.solved[j] = 3
+            ch.changed = True
+            active_chal.discard((user_id, ch.server_id))
+
+    def begin_drain(self, ch: LiveChallenge):
+        ch.state = "draining"
+        self.render(ch)
+        self.at(self.clock(), self.drain_step, ch)
+
+    def drain_step(self, ch: LiveChallenge):
+        if ch.state == "draining":
+            self.spawn(self.drain(ch))
+
+    async def drain(self, ch: LiveChallenge):
+        # for up to 5 minutes, wait for submissions still in the queue (or for codeforces to come back)
+        try:
+            if ch.polling:
+                self.at(self.clock() + 1, self.drain_step, ch)
+                return
+            if ch.drain_until is None:
+                ch.drain_until = self.clock() + self.drain_limit
+            unsolved = [j for j in range(len(ch.users)) if ch.solved[j] == 0]
+            if unsolved and self.clock() < ch.drain_until:
+                ok = [False]
+                await asyncio.gather(*(sub_in_queue(self.egg, ch.handles[j], ch.start, ch.length, ch.problem, ok, budget=self.drain_interval) for j in unsolved))
+                # while codeforces is down the polls fail, so keep waiting instead of settling
+                if ok[0] or await self.egg.breaker_state("contest.status") != "closed":
+                    logger.info("Waiting for submission to be judged...")
+                    self.at(self.clock() + self.drain_interval, self.drain_step, ch)
+                    return
+            await self.finish(ch)
+        except Exception as e:
+            await self.fail(ch, e)
+
+    async def finish(self, ch: LiveChallenge):
+        # everyone still unsolved now gets settled together
+        updates = []
+        for j in range(len(ch.users)):
+            if ch.solved[j] == 0:
+                if await got_ac(self.egg, ch.handles[j], ch.problem, ch.length, ch.start):
+                    await self.solve(ch, j)
+                if ch.solved[j] == 0:
+                    r = await util.get_rating(ch.server_id, ch.users[j])
+                    if (ch.users[j], ch.server_id) in active_chal:
+                        active_chal.discard((ch.users[j], ch.server_id))
+                        l = util.get_rating_changes(r, util.catalog.rating(ch.problem), ch.length)
+                        updates.append((ch.server_id, ch.users[j], r + l[0], ch.problem, ch.length))
+        if updates:
+            await settlement.settle(updates)
+        ch.state = "settled"
+        self.forget(ch)
+        if ch.view is not None:
+            await ch.view.update(ch)
+
+    async def fail(self, ch: LiveChallenge, e: Exception):
+        logger.error(f"Some error: {e}")
+        if ch.state == "settled":
+            return
+        ch.state = "settled"
+        self.forget(ch)
+        for user_id in ch.users:
+            active_chal.discard((user_id, ch.server_id))
+        if ch.view is not None:
+            try:
+                await ch.view.failed(ch)
+            except Exception as e:
+                logger.error(f"Error while updating challenge message: {e}")
+
+async def sub_in_queue(egg, handle: str, start_time: int, length: int, problem: str, ok: list, budget: float = None):
+    try:
+        subs = await egg.extract("submissions", "contest.status", {"contestId" : util.catalog.contest_id(problem), "asManager" : "false", "from" : 1, "count" : 100, "handle" : handle}, priority="critical", hedge=True, budget=budget)
+
+        for _, created, pid, verdict in subs:
+            if problem == pid and verdict == "TESTING":
+                if created <= start_time + length * 60 and created >= start_time:
+                    ok[0] |= True
+                    return
+
+    except (CircuitOpen, DeadlineExceeded):
+        return
+    except Exception as e:
+        logger.error(f"Error during challenge: {e}")
+        return
+
+async def got_ac(egg, handle: str, problem: str, length: int, start_time: int, budget: float = None):
+    try:
+        subs = await egg.extract("submissions", "contest.status", {"contestId" : util.catalog.contest_id(problem), "asManager" : "false", "from" : 1, "count" : 100, "handle" : handle}, priority="critical", hedge=True, budget=budget)
+
+        for _, created, pid, verdict in subs:
+            if problem == pid and verdict == "OK":
+                if created <= start_time + length * 60 and created >= start_time:
+                    return True
+
+        return False
+
+    except (CircuitOpen, DeadlineExceeded):
+        return False
+    except Exception as e:
+        logger.error(f"Error during challenge: {e}")
+        return False
+
+async def update_rating(server_id: int, user_id: int, rating: int, problem: str, length: int = None):
+    # goes through the shared settlement queue, returns once the write is committed
+    with tracing.span("db", "update_rating"):
+        await settlement.settle([(server_id, user_id, rating, problem, length)])
@@ -4,7 +4,7 @@ import logging
 from discord.ext import commands
 from main import global_cooldown
 
-logger = logging.getLogger("bot_logger")
+logger = logging.getLogger("bot_logger.history")
 
 class History(commands.Cog):
     def __init__(self, bot):
@@ -25,35 +25,27 @@ class History(commands.Cog):
         id = member.id if member else ctx.author.id
         name = member.name if member else ctx.author.name
         try:
-            h = await util.get_history_with_rating_history(ctx.guild.id, id)
+            h = await util.get_history_page(ctx.guild.id, id, page)
             if h is None:
                 await ctx.send("No history...")
                 return
-            if util.problem_dict is None:
+            if util.catalog is None:
                 await ctx.send("Wait a bit.")
                 return
-            h[0].reverse()
-            h[1].reverse()
-            ind = (page - 1) * 10
-            if ind >= len(h[0]):
+            count, rows = h
+            if not rows:
                 await ctx.send("Empty page.")
                 return
-            embed = discord.Embed(title=f"History of {name}", description=f"Page {page}", color=discord.Color.blue())
+            embed = discord.Embed(title=f"History of {name}", description=f"Page {page} of {(count + 9) // 10}", color=discord.Color.blue())
             s = ""
-            for i in range(10):
-                if ind + i >= len(h[0]):
-                    break
-                name = h[0][ind + i]
-                s += f"- [{name}. {util.problem_dict[name]["name"]}](https://codeforces.com/problemset/problem/{util.problem_dict[name]["contestId"]}/{util.problem_dict[name]["index"]})"
-                s += f" ({h[1][ind + i + 1]} -> {h[1][ind + i]}, {h[1][ind + i] - h[1][ind + i + 1]})\n"
+            for name, before, after in rows:
+                s += f"- [{name}. {util.catalog[name].name}]({util.catalog[name].url})"
+                s += f" ({before} -> {after}, {after - before})\n"
             if len(s) > 1024:
                 s = ""
-                for i in range(10):
-                    if ind + i >= len(h[0]):
-                        break
-                    name = h[0][ind + i]
-                    s += f"- [{name}](https://codeforces.com/problemset/problem/{util.problem_dict[name]["contestId"]}/{util.problem_dict[name]["index"]})"
-                    s += f" ({h[1][ind + i + 1]} -> {h[1][ind + i]}, {h[1][ind + i] - h[1][ind + i + 1]})\n"
+                for name, before, after in rows:
+                    s += f"- [{name}]({util.catalog[name].url})"
+                    s += f" ({before} -> {after}, {after - before})\n"
             embed.add_field(name="Problems", value=s, inline=False)
             await ctx.send(embed=embed)
         except Exception as e:
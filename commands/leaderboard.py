@@ -1,10 +1,20 @@
 import util
 import discord
 import logging
+import ranking
 from discord.ext import commands
 from main import global_cooldown
 
-logger = logging.getLogger("bot_logger")
+logger = logging.getLogger("bot_logger.leaderboard")
+
+def medal(rank: int):
+    if rank == 1:
+        return " :first_place:"
+    if rank == 2:
+        return " :second_place:"
+    if rank == 3:
+        return " :third_place:"
+    return ""
 
 class Leaderboard(commands.Cog):
     def __init__(self, bot):
@@ -18,34 +28,82 @@ class Leaderboard(commands.Cog):
             await ctx.send("Invalid page.")
             return
         try:
-            lb = await util.get_leaderboard(ctx.guild.id)
-            if lb is None:
-                await ctx.send("Some error occurred.")
-                return
-            ind = (page - 1) * 10
-            if ind >= len(lb):
+            lb = await ranking.get_ranking(ctx.guild.id)
+            rows = lb.page((page - 1) * 10, 10)
+            if not rows:
                 await ctx.send("Empty page.")
                 return
             embed = discord.Embed(title="Leaderboard", description=f"Page {page}", color=discord.Color.blue())
             s = ""
-            for i in range(10):
-                if ind + i >= len(lb):
-                    break
-                user = await ctx.guild.fetch_member(lb[ind + i][0])
-                s += f"{ind + i + 1}. {user.mention} ({lb[ind + i][1]})"
-                if ind + i == 0:
-                    s += " :first_place:\n"
-                elif ind + i == 1:
-                    s += " :second_place:\n"
-                elif ind + i == 2:
-                    s += " :third_place:\n"
-                else:
-                    s += "\n"
+            for rank, user_id, rating in rows:
+                user = await ctx.guild.fetch_member(user_id)
+                s += f"{rank}. {user.mention} ({rating}){medal(rank)}\n"
             embed.add_field(name="Users", value=s, inline=False)
             await ctx.send(embed=embed)
         except Exception as e:
             logger.error(f"Error during leaderboard command: {e}")
             await ctx.send("Something went wrong.")
 
+    @commands.command(help="Shows your (or another user's) position in the server leaderboard")
+    @global_cooldown()
+    async def rank(self, ctx, member: discord.Member = commands.param(default=None, description=": User to show the rank of (e.g. @eggag32) (optional)")):
+        if not member is None:
+            if not isinstance(member, discord.Member):
+                await ctx.send("Invalid member.")
+                return
+        id = member.id if member else ctx.author.id
+        mention = member.mention if member else ctx.author.mention
+        try:
+            lb = await ranking.get_ranking(ctx.guild.id)
+            rank = lb.rank(id)
+            if rank is None:
+                await ctx.send("Handle not linked.")
+                return
+            embed = discord.Embed(title="Rank", description=f"{mention} is #{rank} of {lb.total}", color=util.getColor(lb.ratings[id]))
+            s = ""
+            for r, user_id, rating in lb.around(id, 2):
+                line = f"{r}. <@{user_id}> ({rating}){medal(r)}"
+                s += f"**{line}**\n" if user_id == id else f"{line}\n"
+            embed.add_field(name="Nearby", value=s, inline=False)
+            await ctx.send(embed=embed)
+        except Exception as e:
+            logger.error(f"Error during rank command: {e}")
+            await ctx.send("Something went wrong.")
+
+    @commands.command(help="Shows the leaderboard of handles over every server")
+    @global_cooldown()
+    async def globalboard(self, ctx, order: str = commands.param(default="best", description=": best, avg or solved"),
+                          page: int = commands.param(default=1, description=": Page number")):
+        if isinstance(order, str) and order.isdigit():
+            order, page = "best", int(order)
+        if order not in util.global_orders:
+            await ctx.send("Order should be best, avg or solved.")
+            return
+        if not isinstance(page, int) or page < 1:
+            await ctx.send("Invalid page.")
+            return
+        try:
+            rows = await util.get_global_page(order, page)
+            if not rows:
+                await ctx.send("Empty page.")
+                return
+            titles = {"best": "best rating", "avg": "average rating", "solved": "challenges solved"}
+            embed = discord.Embed(title="Global leaderboard", description=f"By {titles[order]}, page {page}", color=discord.Color.blue())
+            s = ""
+            for i, (handle, guilds, best, avg, solved, challenges) in enumerate(rows):
+                rank = (page - 1) * 10 + i + 1
+                if order == "solved":
+                    value = f"{solved}/{challenges} solved"
+                elif order == "avg":
+                    value = f"{avg:.0f} avg over {guilds} server{'s' if guilds != 1 else ''}"
+                else:
+                    value = f"{best}"
+                s += f"{rank}. [{handle}](https://codeforces.com/profile/{handle}) ({value}){medal(rank)}\n"
+            embed.add_field(name="Handles", value=s, inline=False)
+            await ctx.send(embed=embed)
+        except Exception as e:
+            logger.error(f"Error during globalboard command: {e}")
+            await ctx.send("Something went wrong.")
+
 async def setup(bot):
-    await bot.add_cog(Leaderboard(bot))
\ No newline at end of file
+    await bot.add_cog(Leaderboard(bot))
@@ -0,0 +1,72 @@
+import os
+import asyncio
+import discord
+import logging
+import monitor
+import backup
+from discord.ext import commands
+
+logger = logging.getLogger("bot_logger.owner")
+
+class Owner(commands.Cog):
+    max_attachment = 8 * 1024 * 1024
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.egg = bot.egg
+
+    @commands.command(help="Shows event loop lag stats (owner only)", hidden=True)
+    @commands.is_owner()
+    async def lag(self, ctx):
+        try:
+            st = monitor.lag_monitor.stats()
+            embed = discord.Embed(title="Event loop lag", description=f"{st['samples']} samples", color=discord.Color.blue())
+            embed.add_field(name="Summary", value=f"mean {st['mean'] * 1000:.1f}ms, p50 <= {st['p50'] * 1000:.0f}ms, p99 <= {st['p99'] * 1000:.0f}ms, max {st['max'] * 1000:.0f}ms", inline=False)
+            s = ""
+            for bound, count in st["histogram"]:
+                if count > 0:
+                    s += f"<= {bound * 1000:.0f}ms: {count}\n" if bound != float("inf") else f"> 5000ms: {count}\n"
+            embed.add_field(name="Histogram", value=s or "Nothing yet.", inline=False)
+            s = ""
+            for stall in reversed(st["stalls"][-5:]):
+                s += f"- <t:{int(stall['time'])}:R> {stall['lag']:.2f}s, {stall['command'] or stall['task']}\n"
+            embed.add_field(name="Recent stalls", value=s or "None.", inline=False)
+            await ctx.send(embed=embed)
+        except Exception as e:
+            logger.error(f"Error in lag: {e}")
+            await ctx.send("Something went wrong.")
+
+    @commands.command(help="Makes a consistent copy of the database (owner only)", hidden=True)
+    @commands.is_owner()
+    async def backup(self, ctx):
+        try:
+            # the sqlite backup runs in steps on a worker thread, the bot keeps serving meanwhile
+            dest, size = await asyncio.to_thread(backup.backup)
+            await ctx.send(f"Backup written to `{dest}` ({size / 1e6:.1f} MB).")
+        except Exception as e:
+            logger.error(f"Error in backup: {e}")
+            await ctx.send("Something went wrong.")
+
+    @commands.command(help="Exports a server's users and challenges as JSONL (owner only)", hidden=True)
+    @commands.is_owner()
+    async def export(self, ctx, guild: int = commands.param(default=None, description=": Server ID (default: this server)")):
+        try:
+            guild = guild if guild is not None else ctx.guild.id
+            dest, counts = await asyncio.to_thread(backup.export_file, guild)
+            text = f"Exported {counts['user']} users and {counts['challenge']} challenges to `{dest}`."
+            # member ids and handles, so the file only goes to the owner's DMs and never to a server channel
+            if os.path.getsize(dest) <= self.max_attachment:
+                try:
+                    await ctx.author.send(text, file=discord.File(dest))
+                    if ctx.guild is None:
+                        return
+                    text += " The file is in your DMs."
+                except discord.Forbidden:
+                    text += " Couldn't DM you the file."
+            await ctx.send(text)
+        except Exception as e:
+            logger.error(f"Error in export: {e}")
+            await ctx.send("Something went wrong.")
+
+async def setup(bot):
+    await bot.add_cog(Owner(bot))
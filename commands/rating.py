@@ -1,12 +1,11 @@
-import matplotlib.pyplot as plt
 import discord
 import util
-import io
+import rating_chart
 import logging
 from discord.ext import commands
 from main import global_cooldown
 
-logger = logging.getLogger("bot_logger")
+logger = logging.getLogger("bot_logger.rating")
 
 class Rating(commands.Cog):
     def __init__(self, bot):
@@ -33,29 +32,7 @@ class Rating(commands.Cog):
                 await ctx.send("Something went wrong, somehow the user doesn't have a rating...")
                 return
             pY = await util.get_rating_history(ctx.guild.id, id)
-            pX = [i + 1 for i in range(len(pY))]
-            fig, ax = plt.subplots()
-            ax.axhspan(-1000, 1200, facecolor="gray", alpha=0.5)
-            ax.axhspan(1200, 1400, facecolor="lime", alpha=0.5)
-            ax.axhspan(1400, 1600, facecolor="cyan", alpha=0.5)
-            ax.axhspan(1600, 1900, facecolor="blue", alpha=0.5)
-            ax.axhspan(1900, 2100, facecolor="purple", alpha=0.5)
-            ax.axhspan(2100, 2300, facecolor="yellow", alpha=0.5)
-            ax.axhspan(2300, 2400, facecolor="orange", alpha=0.7)
-            ax.axhspan(2400, 2600, facecolor="red", alpha=0.7)
-            ax.axhspan(2600, 3000, facecolor="pink", alpha=0.9)
-            ax.axhspan(3000, 5000, facecolor="magenta", alpha=0.7)
-            ax.plot(pX, pY, marker="o", linestyle="-", color="blue", markerfacecolor="blue", markeredgecolor="blue", markersize=6)
-            ax.set_ylim(min(pY) - 100, max(pY) + 100)
-            l = [0, 1200, 1400, 1600, 1900, 2100, 2300, 2400, 2600, 3000]
-            t = [i for i in l if i >= min(pY) - 100 and i <= max(pY) + 100]
-            ax.set_yticks(t)
-            ax.set_xticks(range(1, len(pY) + 1, 1))
-            ax.set_title(f"Rating history of {name}")
-            img_buffer = io.BytesIO()
-            plt.savefig(img_buffer, format="png", bbox_inches="tight")
-            plt.close()
-            img_buffer.seek(0)
+            img_buffer = rating_chart.render(pY, f"Rating history of {name}")
             discord_file = discord.File(img_buffer, filename="image.png")
             embed = discord.Embed(title="Rating graph", description=f"{mention}'s rating is {r}", color=discord.Color.blue())
             embed.set_image(url="attachment://image.png")
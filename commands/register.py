@@ -1,15 +1,19 @@
 import asyncio
 import time
-import aiosqlite
+import shards
 import random
 import discord
 import util
 import logging
+import tracing
+import ranking
 from discord.ext import commands
 from main import global_cooldown
 from exceptions import DatabaseError
 
-logger = logging.getLogger("bot_logger")
+logger = logging.getLogger("bot_logger.register")
+# someone is waiting on each of these requests, better to tell them it failed than to retry for minutes
+request_budget = 30.0
 
 class Register(commands.Cog):
     def __init__(self, bot):
@@ -23,8 +27,12 @@ class Register(commands.Cog):
             await ctx.send("Invalid handle.")
             return
         try: 
+            busy = await util.busy_message(self.egg, "user.info")
+            if busy:
+                await ctx.send(busy)
+                return
             try:
-                b = await util.handle_exists_on_cf(self.egg, handle)
+                b = await util.handle_exists_on_cf(self.egg, handle, budget=request_budget, hedge=True)
                 if not b:
                     await ctx.send("Invalid handle.")
                     return
@@ -91,23 +99,23 @@ async def setup(bot):
     await bot.add_cog(Register(bot))
 
 async def validate_handle(ctx, egg, server_id: int, user_id: int, handle: str, msg: list):
-    if util.problems is None:
+    if util.catalog is None:
         try:
-            await util.get_problems()    
+            await util.get_problems(egg)
         except Exception as e:
             logger.error(f"Failed to get problems: {e}")
             return 5
 
-    problem = util.problems[random.randint(0, len(util.problems) - 1)]
+    problem = util.catalog.at(random.randint(0, len(util.catalog) - 1))
     t = time.time()
-    embed = discord.Embed(title="Verify your handle", description=f"Submit a compilation error to the following problem in the next 60 seconds:\nhttps://codeforces.com/problemset/problem/{problem['contestId']}/{problem['index']}", color=discord.Color.blue())
+    embed = discord.Embed(title="Verify your handle", description=f"Submit a compilation error to the following problem in the next 60 seconds:\n{problem.url}", color=discord.Color.blue())
     message = await ctx.send(embed=embed)
     msg[0] = message.id
 
     await asyncio.sleep(60)
     if not await got_submission(egg, handle, problem, t):
         return 2
-    async with aiosqlite.connect(util.path + "bot_data.db") as db:
+    async with shards.connect(server_id) as db:
         try:
             await db.execute("BEGIN TRANSACTION")
 
@@ -131,8 +139,10 @@ async def validate_handle(ctx, egg, server_id: int, user_id: int, handle: str, m
                 "INSERT INTO users (server_id, user_id, handle, rating, history, rating_history) VALUES (?, ?, ?, ?, ?, ?)",
                 (server_id, user_id, handle, 1500, history, rating_history)
             )
+            await util.refresh_global_handle(db, handle)
 
             await db.commit()
+            ranking.update(server_id, user_id, 1500)
             return 1
         except Exception as e:
             await db.rollback()
@@ -142,24 +152,28 @@ async def validate_handle(ctx, egg, server_id: int, user_id: int, handle: str, m
 async def got_submission(egg, handle: str, problem, t):
     try:
 
-        response_data = await egg.codeforces("contest.status", {"contestId" : problem["contestId"], "asManager" : "false", "from" : 1, "count" : 10, "handle" : handle})
-
-        if response_data["status"] != "OK":
-            return False
+        subs = await egg.extract("submissions", "contest.status", {"contestId" : problem.contest_id, "asManager" : "false", "from" : 1, "count" : 10, "handle" : handle}, hedge=True, budget=request_budget)
 
-        for o in response_data["result"]:
-            if o["problem"]["index"] == problem["index"] and o["verdict"] == "COMPILATION_ERROR" and o["contestId"] == problem["contestId"]:
-                return o["creationTimeSeconds"] > t
+        for _, created, pid, verdict in subs:
+            if pid == problem.id and verdict == "COMPILATION_ERROR":
+                return created > t
 
     except Exception as e:
         logger.error(f"Error getting submission, got_submission(): {e}")
         return False
 
+@tracing.traced("db")
 async def unlink(server_id: int, user_id: int):
     try:
-        async with aiosqlite.connect(util.path + "bot_data.db") as db:
+        async with shards.connect(server_id) as db:
+            async with db.execute("SELECT handle FROM users WHERE server_id = ? AND user_id = ?", (server_id, user_id)) as cursor:
+                row = await cursor.fetchone()
             await db.execute("DELETE FROM users WHERE server_id = ? AND user_id = ?", (server_id, user_id))
+            await db.execute("DELETE FROM challenges WHERE server_id = ? AND user_id = ?", (server_id, user_id))
+            if row:
+                await util.refresh_global_handle(db, row[0])
             await db.commit()
+        ranking.remove(server_id, user_id)
     except Exception as e:
         logger.error(f"Database error, unlink(): {e}")
         raise DatabaseError(e)
\ No newline at end of file
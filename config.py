@@ -0,0 +1,27 @@
+import json
+import os
+import logging
+from pathlib import Path
+
+logger = logging.getLogger("bot_logger.config")
+path = str(Path(__file__).parent) + "/"
+
+# optional overrides, everything has a default so config.json does not need to exist
+settings = {}
+
+def load():
+    global settings
+    if not os.path.isfile(path + "config.json"):
+        settings = {}
+        return
+    try:
+        with open(path + "config.json", encoding="utf-8") as config_file:
+            settings = json.load(config_file)
+    except Exception as e:
+        logger.error(f"Failed to load config.json: {e}")
+        settings = {}
+
+def get(key: str, default=None):
+    return settings.get(key, default)
+
+load()
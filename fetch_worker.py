@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import asyncio
+import logging
+import itertools
+from typing import Any, Dict, Optional
+
+import logs
+import config
+import proxy
+from proxy import CFError, CircuitOpen, DeadlineExceeded, Overloaded
+import tracing
+from exceptions import RequestError
+from pathlib import Path
+
+logger = logging.getLogger("bot_logger.fetch_worker")
+path = str(Path(__file__).parent) + "/"
+
+# big enough for a full problemset.problems line
+line_limit = 1 << 26
+
+def socket_path():
+    return config.get("fetch_worker_socket", path + "eggfetch.sock")
+
+async def serve_request(egg: proxy.EggFetch, req: dict) -> dict:
+    try:
+        opts = req.get("opts") or {}
+        if req["op"] == "codeforces":
+            result = await egg.codeforces(req["endpoint"], req.get("params"), **opts)
+        elif req["op"] == "extract":
+            result = await egg.extract(req["name"], req["endpoint"], req.get("params"), **opts)
+        elif req["op"] == "admit":
+            await egg.admit(req.get("priority", "interactive"), req.get("max_wait"), req.get("endpoint"))
+            result = None
+        elif req["op"] == "breaker":
+            result = await egg.breaker_state(req.get("endpoint"))
+        elif req["op"] == "stats":
+            result = await egg.stats()
+        elif req["op"] == "ping":
+            result = "pong"
+        else:
+            raise ValueError(f"Unknown op {req['op']}")
+        return {"id": req["id"], "ok": True, "result": result}
+    except CFError as e:
+        return {"id": req["id"], "ok": False, "cf": True, "error": e.comment, "unavailable": e.unavailable}
+    except CircuitOpen as e:
+        return {"id": req["id"], "ok": False, "cf": False, "circuit_open": [e.endpoint, e.retry_in], "error": str(e)}
+    except Overloaded as e:
+        return {"id": req["id"], "ok": False, "cf": False, "overloaded": e.eta, "error": str(e)}
+    except DeadlineExceeded as e:
+        return {"id": req["id"], "ok": False, "cf": False, "deadline": e.endpoint, "error": str(e)}
+    except Exception as e:
+        return {"id": req["id"], "ok": False, "cf": False, "error": f"{type(e).__name__}: {e}"}
+
+async def handle_client(egg: proxy.EggFetch, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    write_lock = asyncio.Lock()
+    tasks = set()
+
+    async def serve(req: dict):
+        resp = await serve_request(egg, req)
+        async with write_lock:
+            writer.write(json.dumps(resp, separators=(",", ":")).encode() + b"\n")
+            await writer.drain()
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            task = asyncio.create_task(serve(json.loads(line)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except Exception as e:
+        logger.error(f"Fetch worker client error: {e}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        writer.close()
+
+async def run_worker():
+    egg = await proxy.eggfetch()
+    sock = socket_path()
+    if os.path.exists(sock):
+        os.remove(sock)
+    server = await asyncio.start_unix_server(lambda r, w: handle_client(egg, r, w), path=sock, limit=line_limit)
+    logger.info(f"Fetch worker listening on {sock}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await egg.close()
+
+class EggFetchClient:
+    # talks to fetch_worker.py over a unix socket, same calls as proxy.EggFetch
+    reconnect_tries = 40
+    reconnect_wait = 0.5
+
+    def __init__(self, sock: str, process: Optional[asyncio.subprocess.Process] = None):
+        self.sock = sock
+        self.process = process
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.pending: dict[int, asyncio.Future] = {}
+        self.ids = itertools.count()
+        self.connect_lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self.connect_lock:
+            if self.writer is not None and not self.writer.is_closing():
+                return
+            err = None
+            for _ in range(self.reconnect_tries):
+                try:
+                    self.reader, self.writer = await asyncio.open_unix_connection(self.sock, limit=line_limit)
+                    self.reader_task = asyncio.create_task(self.read_loop())
+                    return
+                except OSError as e:
+                    err = e
+                    await asyncio.sleep(self.reconnect_wait)
+            raise RequestError(f"could not reach fetch worker: {err}")
+
+    async def read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                resp = json.loads(line)
+                fut = self.pending.pop(resp["id"], None)
+                if fut is None or fut.done():
+                    continue
+                if resp["ok"]:
+                    fut.set_result(resp["result"])
+                elif "overloaded" in resp:
+                    fut.set_exception(Overloaded(resp["overloaded"]))
+                elif "circuit_open" in resp:
+                    fut.set_exception(CircuitOpen(*resp["circuit_open"]))
+                elif "deadline" in resp:
+                    fut.set_exception(DeadlineExceeded(resp["deadline"]))
+                elif resp["cf"]:
+                    fut.set_exception(CFError(resp["error"], resp.get("unavailable", False)))
+                else:
+                    fut.set_exception(RequestError(resp["error"]))
+        except Exception as e:
+            logger.error(f"Fetch worker connection error: {e}")
+        finally:
+            # worker went away (or restarted), anyone still waiting has to retry
+            self.writer.close()
+            for fut in self.pending.values():
+                if not fut.done():
+                    fut.set_exception(RequestError("fetch worker disconnected"))
+            self.pending.clear()
+
+    async def request(self, req: dict) -> Any:
+        await self.connect()
+        req["id"] = next(self.ids)
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[req["id"]] = fut
+        self.writer.write(json.dumps(req, separators=(",", ":")).encode() + b"\n")
+        await self.writer.drain()
+        return await fut
+
+    async def codeforces(self, endpoint: str, params: Optional[Dict[str, str]] = None, **opts) -> Any:
+        # queue wait and http happen in the worker, so this one span covers both
+        with tracing.span("cf", endpoint):
+            return await self.request({"op": "codeforces", "endpoint": endpoint, "params": params, "opts": opts})
+
+    async def extract(self, name: str, endpoint: str, params: Optional[Dict[str, str]] = None, **opts) -> Any:
+        with tracing.span("cf", endpoint):
+            return await self.request({"op": "extract", "name": name, "endpoint": endpoint, "params": params, "opts": opts})
+
+    async def admit(self, priority: str = "interactive", max_wait: Optional[float] = None, endpoint: Optional[str] = None):
+        await self.request({"op": "admit", "priority": priority, "max_wait": max_wait, "endpoint": endpoint})
+
+    async def breaker_state(self, endpoint: Optional[str] = None) -> str:
+        return await self.request({"op": "breaker", "endpoint": endpoint})
+
+    async def stats(self) -> dict:
+        return await self.request({"op": "stats"})
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+            await self.process.wait()
+
+async def connect():
+    sock = socket_path()
+    process = None
+    if config.get("fetch_worker_spawn", True):
+        process = await asyncio.create_subprocess_exec(sys.executable, path + "fetch_worker.py")
+    client = EggFetchClient(sock, process)
+    await client.connect()
+    await client.request({"op": "ping"})
+    return client
+
+if __name__ == "__main__":
+    logs.setup(path + "fetch_worker.log", "[fetch_worker] ")
+    asyncio.run(run_worker())
@@ -0,0 +1,122 @@
+import os
+import gzip
+import json
+import time
+import queue
+import atexit
+import shutil
+import logging
+import contextvars
+import logging.handlers
+
+import config
+
+# Every log call only puts the record on a queue; a listener thread formats it and does the file
+# and console I/O, so the event loop never waits on the disk. The file gets one JSON object per
+# line (with guild, command and latency when logged during a command) and is rotated by size and
+# by age into gzipped files.
+
+# (command name, guild id, perf_counter at start) of the command being handled, set in main.py and
+# also read by monitor.py to name the command behind a stall
+current_command = contextvars.ContextVar("current_command", default=None)
+
+listener = None
+
+def gzip_rotator(source: str, dest: str):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+class RotatingLogHandler(logging.handlers.RotatingFileHandler):
+    # rotates once the file is over max_bytes or older than interval seconds, keeps backup_count .gz files
+    def __init__(self, filename: str, max_bytes: int, interval: float, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+        self.namer = lambda name: name + ".gz"
+        self.rotator = gzip_rotator
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at:
+            if os.path.isfile(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+                return True
+            self.rollover_at = time.time() + self.interval
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+class JsonFormatter(logging.Formatter):
+    fields = ("guild", "command", "latency")
+
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for field in self.fields:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # runs on the logging thread (usually the loop), so this is where the command context is read
+    def prepare(self, record):
+        ctx = current_command.get()
+        if ctx is not None and getattr(record, "command", None) is None:
+            record.command, record.guild = ctx[0], ctx[1]
+            record.latency = round((time.perf_counter() - ctx[2]) * 1000, 1)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+def logger_name(key: str):
+    # config keys are our module names (proxy, suggest, ...) or full logger names like discord.http
+    if key == "discord" or "." in key or key.startswith("bot_logger"):
+        return key
+    return "bot_logger." + key
+
+def setup(filename: str, console_prefix: str = ""):
+    global listener
+    if listener is not None:
+        return
+    file_handler = RotatingLogHandler(
+        filename,
+        config.get("log_max_bytes", 10 * 1024 * 1024),
+        config.get("log_rotate_interval", 86400),
+        config.get("log_backups", 14)
+    )
+    if config.get("log_json", True):
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter("[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s"))
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(f"[%(asctime)s] [%(levelname)s] {console_prefix}%(message)s"))
+
+    q = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(config.get("log_level", "INFO"))
+    root.addHandler(LogQueueHandler(q))
+    for key, level in config.get("log_levels", {}).items():
+        logging.getLogger(logger_name(key)).setLevel(level)
+
+    listener = logging.handlers.QueueListener(q, file_handler, console, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop)
+
+def stop():
+    # flushes whatever is still queued
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
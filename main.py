@@ -1,11 +1,17 @@
 import os
 import discord
 import asyncio
-import aiosqlite
 import util
 import time
 import logging
+import logs
 import proxy
+import config
+import fetch_worker
+import monitor
+import tracing
+import solved
+import shards
 from discord.ext import commands
 
 intents = discord.Intents.default()
@@ -13,38 +19,12 @@ intents.message_content = True
 
 bot = commands.Bot(command_prefix="=", intents=intents)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(asctime)s] [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(util.path + "bot.log"),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger("bot_log")
+logs.setup(util.path + "bot.log")
+logger = logging.getLogger("bot_logger.main")
 
 async def init_database():
-    async with aiosqlite.connect(util.path + "bot_data.db") as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            server_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            handle TEXT NOT NULL,
-            rating INTEGER NOT NULL,
-            history TEXT DEFAULT '[]',
-            rating_history TEXT DEFAULT '[]',
-            PRIMARY KEY (server_id, user_id)
-        );
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS ac (
-            handle TEXT NOT NULL,
-            solved TEXT DEFAULT '[]',
-            last_sub INTEGER NOT NULL,
-            PRIMARY KEY (handle)  
-        );
-        """)
-        await db.commit()
+    # tables live in bot_data.db, or with db_shards split between it and the shard files
+    await shards.init()
 
 user_cooldowns = {}
 last_request = 0
@@ -84,16 +64,36 @@ async def on_ready():
     logger.info(f'Logged in as {bot.user}')
     await init_database()
 
+@bot.before_invoke
+async def before_command(ctx):
+    name, guild = ctx.command.qualified_name, ctx.guild.id if ctx.guild else None
+    logs.current_command.set((name, guild, time.perf_counter()))
+    tracing.start_trace(name, guild)
+    if ctx.guild:
+        solved.note_activity(ctx.guild.id, ctx.author.id)
+
+@bot.after_invoke
+async def after_command(ctx):
+    tracing.finish_trace(ctx.command_failed)
+
 @bot.command(help="Pings the bot")
 @global_cooldown()
 async def ping(ctx):
     await ctx.send('Pong!')
 
 async def load_cogs():
-    egg = await proxy.eggfetch()
+    monitor.lag_monitor.start(asyncio.get_running_loop())
+    tracing.instrument_http(bot.http)
+    if config.get("fetch_worker", False):
+        # codeforces traffic and json decoding happen in fetch_worker.py instead of on this loop
+        egg = await fetch_worker.connect()
+    else:
+        egg = await proxy.eggfetch()
     bot.egg = egg
     await init_database()
     bot.loop.create_task(util.parse_data(egg))
+    if config.get("prewarm", True):
+        bot.loop.create_task(solved.prewarm_loop(egg))
     for filename in os.listdir(util.path + "commands"):
         if filename.endswith(".py") and filename != "__init__.py":
             try:
@@ -0,0 +1,108 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import deque
+
+import logs
+import config
+
+logger = logging.getLogger("bot_logger.monitor")
+
+class LagMonitor:
+    interval = 0.1
+    threshold = config.get("lag_threshold", 0.25)
+    # upper bounds in seconds, the last bucket catches everything else
+    buckets = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf")]
+
+    def __init__(self):
+        self.counts = [0 for _ in self.buckets]
+        self.samples = 0
+        self.total = 0.0
+        self.max_lag = 0.0
+        self.stalls = deque(maxlen=20)
+        self.loop = None
+        self.thread_id = None
+        self.last_tick = time.monotonic()
+        self.captured = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        if self.loop is not None:
+            return
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.task = loop.create_task(self.run())
+        threading.Thread(target=self.watch, name="lag-watchdog", daemon=True).start()
+
+    def record(self, lag: float):
+        for i, bound in enumerate(self.buckets):
+            if lag <= bound:
+                self.counts[i] += 1
+                break
+        self.samples += 1
+        self.total += lag
+        self.max_lag = max(self.max_lag, lag)
+
+    async def run(self):
+        while True:
+            t = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - t - self.interval)
+            self.record(lag)
+            self.last_tick = now
+            if self.captured is not None:
+                self.captured["lag"] = lag
+                logger.warning(f"Event loop was blocked for {lag:.3f}s (command: {self.captured['command']})")
+                self.captured = None
+
+    def watch(self):
+        # runs in its own thread, so it still gets to run while the loop is stuck
+        while True:
+            time.sleep(self.threshold / 2)
+            stuck = time.monotonic() - self.last_tick - self.interval
+            if stuck > self.threshold and self.captured is None:
+                self.capture(stuck)
+
+    def capture(self, stuck: float):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+        command = None
+        task_name = None
+        task = asyncio.current_task(self.loop)
+        if task is not None:
+            task_name = task.get_name()
+            # the same command context the log records get, so a stall is blamed on the command that caused it
+            ctx = task.get_context().get(logs.current_command)
+            if ctx is not None:
+                command = f"{ctx[0]} (guild {ctx[1]})"
+        self.captured = {"time": time.time(), "lag": stuck, "task": task_name, "command": command, "stack": stack}
+        self.stalls.append(self.captured)
+        logger.warning(f"Event loop blocked for over {stuck:.3f}s in task {task_name} (command: {command}):\n{stack}")
+
+    def percentile(self, q: float):
+        if self.samples == 0:
+            return 0.0
+        target = q * self.samples
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound if bound != float("inf") else self.max_lag
+        return self.max_lag
+
+    def stats(self):
+        return {
+            "samples": self.samples,
+            "mean": self.total / self.samples if self.samples else 0.0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max_lag,
+            "histogram": list(zip(self.buckets, self.counts)),
+            "stalls": list(self.stalls)
+        }
+
+lag_monitor = LagMonitor()
@@ -1,78 +1,428 @@
 from collections import deque
 from dataclasses import dataclass
 import os
+import time
 import logging
 from typing import Any, AsyncIterator, Awaitable, Callable, Optional, Dict, TypedDict, Unpack
 import asyncio
+import itertools
 import json
 from random import shuffle as random_shuffle
 from urllib.parse import urlencode, urljoin
 
 import aiohttp
 
-logger = logging.getLogger("bot_logger")
+import config
+import tracing
+
+logger = logging.getLogger("bot_logger.proxy")
 
 class CFError(Exception):
-    def __init__(self, comment: Optional[str] = None):
+    def __init__(self, comment: Optional[str] = None, unavailable: bool = False):
         super().__init__(f"Codeforces API error: {comment or 'unknown error'}")
         self.comment = comment
+        # codeforces itself is down (error page instead of an api answer)
+        self.unavailable = unavailable
+
+class Overloaded(Exception):
+    def __init__(self, eta: float):
+        super().__init__(f"Codeforces queue is full (estimated wait {eta:.0f}s)")
+        self.eta = eta
+
+class CircuitOpen(Exception):
+    def __init__(self, endpoint: str, retry_in: float):
+        super().__init__(f"Codeforces {endpoint} is failing, not sending requests for {retry_in:.0f}s")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+class DeadlineExceeded(Exception):
+    def __init__(self, endpoint: str):
+        super().__init__(f"Codeforces {endpoint} request ran out of time")
+        self.endpoint = endpoint
 
 @dataclass
 class EggProxy:
     url: str
     auth: aiohttp.BasicAuth
 
+@dataclass
+class ProxyHealth:
+    # moving averages over real requests and probes
+    latency: float = 0.0
+    success: float = 1.0
+    samples: int = 0
+    last_used: float = 0.0
+
+    def record(self, ok: bool, latency: float, alpha: float):
+        if self.samples == 0:
+            self.latency = latency
+        else:
+            self.latency += alpha * (latency - self.latency)
+        self.success += alpha * ((1.0 if ok else 0.0) - self.success)
+        self.samples += 1
+        self.last_used = time.monotonic()
+
+    def bad(self, min_success: float, max_latency: float):
+        return self.samples >= 3 and (self.success < min_success or self.latency > max_latency)
+
+    def score(self):
+        return self.success / (1.0 + self.latency)
+
+class CircuitBreaker:
+    # closed: everything goes through. open: everything is refused until the cooldown is over.
+    # half_open: one request is let through to see if codeforces is back, success closes the
+    # breaker and failure opens it again with a longer cooldown
+    threshold = config.get("breaker_threshold", 5)
+    cooldown = config.get("breaker_cooldown", 30.0)
+    max_cooldown = 300.0
+    cooldown_mul = 2.0
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.current_cooldown = self.cooldown
+
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_at + self.current_cooldown - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and self.retry_in() == 0.0:
+            self.state = "half_open"
+            return True
+        return False
+
+    def record(self, ok: Optional[bool]):
+        # None means the request never finished (cancelled), so it says nothing either way
+        if ok is None:
+            if self.state == "half_open":
+                self.state = "open"
+            return
+        if ok:
+            if self.state != "closed":
+                logger.info("Codeforces is reachable again, closing breaker")
+            self.state = "closed"
+            self.failures = 0
+            self.current_cooldown = self.cooldown
+            return
+        self.failures += 1
+        if self.state == "half_open":
+            self.current_cooldown = min(self.max_cooldown, self.current_cooldown * self.cooldown_mul)
+        elif self.state == "closed" and self.failures >= self.threshold:
+            self.current_cooldown = self.cooldown
+        else:
+            return
+        self.state = "open"
+        self.opened_at = time.monotonic()
+
 class EggFetchOptions(TypedDict, total=False):
     noproxy: Optional[bool]
     method: Optional[str]
+    # "critical" (verdict polls of running challenges), "interactive" (default) or "background"
+    priority: Optional[str]
+    # send a second attempt on another free dispatcher if the first one is slow (see EggFetch.hedged)
+    hedge: Optional[bool]
+    # give up (DeadlineExceeded) once this time.time() passes, or this many seconds from now,
+    # whether the request is still queued, in an attempt or between retries
+    deadline: Optional[float]
+    budget: Optional[float]
+
+priorities = {"critical": 0, "interactive": 1, "background": 2}
+
+class TrafficRecorder:
+    # one line per attempt: [time, request, attempt, endpoint, priority, noproxy, dispatcher,
+    # queue wait, latency, outcome, hedge], outcome being ok, cf (api error), down (5xx page), 429, err or
+    # cancelled, hedge 1 for the extra attempt of a hedged request.
+    # replay_traffic.py runs the dispatcher scheduling against these on a simulated clock
+    version = 2
+
+    def __init__(self, file_path: str):
+        self.writer = tracing.TraceWriter(file_path)
+        self.ids = itertools.count()
+
+    def header(self, egg: "EggFetch"):
+        self.writer.put(json.dumps({
+            "type": "traffic",
+            "version": self.version,
+            "time": time.time(),
+            "dispatchers": len(egg.pool),
+            "params": {name: getattr(egg, name) for name in ("dispatcher_wait", "dispatcher_error_wait", "dispatcher_error_mul", "max_retry")}
+        }) + "\n")
+
+    def record(self, *fields):
+        self.writer.put(json.dumps(fields, separators=(",", ":")) + "\n")
     
 class EggFetch:
     main_id = 0
+    # dispatchers that are free right now, the rest are in use or cooling down in __add_later
     dispatchers: dict[int, Optional[EggProxy]] = { main_id: None }
+    # every dispatcher in the pool (free or not), keyed the same way
+    pool: dict[int, Optional[EggProxy]] = { main_id: None }
+    # proxies.json line -> dispatcher id, so a reload only touches what changed
+    proxy_lines: dict[str, int] = dict()
+    next_id = 1
+    # taken out of rotation because of bad health, the prober brings them back
+    parked: set[int] = set()
+    # removed by a reload while in use, dropped instead of re-added when they come back
+    retired: set[int] = set()
+    health: dict[int, ProxyHealth] = dict()
+    # one keep-alive pool per dispatcher, so connections (and proxy tunnels) are reused per proxy
+    sessions: dict[int, aiohttp.ClientSession] = dict()
     dispatcher_error_waits: dict[int, float] = dict()
     dispatcher_queue: deque[int] = deque()
     client: aiohttp.ClientSession
 
+    proxies_file = "./proxies.json"
+    proxies_mtime: Optional[float] = None
+    proxy_fetch_url: Optional[str] = None
+    last_proxy_fetch = 0.0
+
+    probe_url = config.get("proxy_probe_url", "https://codeforces.com/api/user.info?handles=tourist")
+    probe_interval = config.get("proxy_probe_interval", 60.0)
+    probe_timeout = 15.0
+    reload_interval = 30.0
+    proxy_fetch_interval = config.get("proxy_fetch_interval", 3600.0)
+    health_alpha = 0.3
+    min_success = 0.5
+    max_latency = 30.0
+
+    # transport settings for the per-dispatcher sessions
+    keepalive_timeout = 60.0
+    dns_cache_ttl = 300
+    connections_per_dispatcher = 4
+    connect_timeout = 10.0
+    read_timeout = 60.0
+    accept_encoding = "gzip, deflate"
+    force_close = False
+
+    # one breaker per api method
+    breakers: dict[str, CircuitBreaker] = dict()
+
+    # admission control, callers waiting for a dispatcher per priority
+    waiting: list[int] = [0, 0, 0]
+    max_queue_depth = config.get("max_queue_depth", 50)
+    max_admit_wait = config.get("max_admit_wait", 60.0)
+
+    recorder: Optional[TrafficRecorder] = None
+
+    # hedged requests fire their second attempt at hedge_percentile of the endpoint's recent
+    # successful latencies. Each hedged request earns hedge_budget tokens (up to hedge_burst) and a
+    # hedge costs one, so at most about that share of them send a second attempt
+    latencies: dict[str, deque[float]] = dict()
+    latency_samples = 200
+    hedge_percentile = config.get("hedge_percentile", 0.95)
+    hedge_budget = config.get("hedge_budget", 0.1)
+    hedge_burst = 5.0
+    hedge_tokens = 1.0
+    hedge_min_samples = 20
+    hedge_min_delay = 1.0
+    hedge_default_delay = 5.0
+    hedges = 0
+    hedge_wins = 0
+
     def __init__(self):
+        # for things that don't go through a dispatcher (fetching the proxy list)
         connector = aiohttp.TCPConnector(limit=None)
         self.client = aiohttp.ClientSession(connector=connector)
         self.dispatcher_queue.append(self.main_id)
-    
-    async def add_proxies(self):
-        if not os.path.isfile("./proxies.json"):
-            return
 
-        with open("./proxies.json", encoding="utf-8") as proxies_file:
-            prox = json.load(proxies_file)
+    def session_for(self, dispatcher_id: int) -> aiohttp.ClientSession:
+        session = self.sessions.get(dispatcher_id)
+        if session is None or session.closed:
+            if self.force_close:
+                connector = aiohttp.TCPConnector(force_close=True, use_dns_cache=True, ttl_dns_cache=self.dns_cache_ttl)
+            else:
+                connector = aiohttp.TCPConnector(
+                    limit=self.connections_per_dispatcher,
+                    keepalive_timeout=self.keepalive_timeout,
+                    use_dns_cache=True,
+                    ttl_dns_cache=self.dns_cache_ttl
+                )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Accept-Encoding": self.accept_encoding},
+                timeout=aiohttp.ClientTimeout(total=self.timeout, connect=self.connect_timeout, sock_read=self.read_timeout)
+            )
+            self.sessions[dispatcher_id] = session
+        return session
+
+    def drop_session(self, dispatcher_id: int):
+        session = self.sessions.pop(dispatcher_id, None)
+        if session is not None:
+            self.tasks.add(asyncio.create_task(session.close()))
+
+    def health_of(self, dispatcher_id: int) -> ProxyHealth:
+        if dispatcher_id not in self.health:
+            self.health[dispatcher_id] = ProxyHealth()
+        return self.health[dispatcher_id]
+
+    async def load_proxy_list(self) -> Optional[list[str]]:
+        if not os.path.isfile(self.proxies_file):
+            return None
+
+        self.proxies_mtime = os.path.getmtime(self.proxies_file)
+
+        def read():
+            with open(self.proxies_file, encoding="utf-8") as proxies_file:
+                return json.load(proxies_file)
+
+        prox = await asyncio.to_thread(read)
 
         if isinstance(prox, dict) and "proxyFetchUrl" in prox:
             logger.info("fetching proxies...")
-            async with aiohttp.ClientSession() as session:
-                async with session.get(prox['proxyFetchUrl']) as response:
-                    proxies=(await response.text()).strip().split("\n")
+            self.proxy_fetch_url = prox["proxyFetchUrl"]
+            self.last_proxy_fetch = time.monotonic()
+            async with self.client.get(self.proxy_fetch_url, timeout=self.timeout) as response:
+                proxies=(await response.text()).strip().split("\n")
         else:
             logger.info("loading proxies...")
+            self.proxy_fetch_url = None
             proxies=list(prox)
 
-        logger.info(f"adding {len(proxies)} proxies")
+        return [p.strip() for p in proxies if p.strip()]
 
-        for pi, p in enumerate(proxies):
+    def apply_proxy_list(self, proxies: list[str]):
+        # call with self.cond held
+        parsed = {}
+        for p in proxies:
             parts = p.split(":")
             if len(parts) != 4:
                 raise ValueError(f"Expected 4 parts (host, port, user, pass) for proxy {p}")
+            parsed[p] = EggProxy(url=f"http://{parts[0]}:{parts[1]}", auth=aiohttp.BasicAuth(parts[2], parts[3]))
+
+        removed = [line for line in self.proxy_lines if line not in parsed]
+        added = [line for line in parsed if line not in self.proxy_lines]
+
+        for line in removed:
+            dispatcher_id = self.proxy_lines.pop(line)
+            self.pool.pop(dispatcher_id, None)
+            was_parked = dispatcher_id in self.parked
+            self.parked.discard(dispatcher_id)
+            self.health.pop(dispatcher_id, None)
+            if was_parked:
+                # nothing brings a parked one back through __add_later, so drop it now
+                self.drop_session(dispatcher_id)
+            elif dispatcher_id in self.dispatchers:
+                # free right now, its queue entry gets skipped
+                self.dispatchers.pop(dispatcher_id)
+                self.drop_session(dispatcher_id)
+            else:
+                # a request is using it, let that finish and drop it afterwards
+                self.retired.add(dispatcher_id)
+
+        new_ids = []
+        for line in added:
+            dispatcher_id = self.next_id
+            self.next_id += 1
+            self.proxy_lines[line] = dispatcher_id
+            self.pool[dispatcher_id] = parsed[line]
+            self.dispatchers[dispatcher_id] = parsed[line]
+            new_ids.append(dispatcher_id)
+
+        random_shuffle(new_ids)
+        self.dispatcher_queue.extend(new_ids)
+        if new_ids:
+            self.cond.notify_all()
 
-            proxy_auth = aiohttp.BasicAuth(parts[2], parts[3])
-            self.dispatchers[pi+1] = EggProxy(
-                url=f"http://{parts[0]}:{parts[1]}",
-                auth=proxy_auth
-            )
-    
-            self.dispatcher_queue.append(pi+1)
+        logger.info(f"proxies: {len(added)} added, {len(removed)} removed, {len(self.proxy_lines)} total")
+
+    async def reload_proxies(self):
+        try:
+            proxies = await self.load_proxy_list()
+        except Exception as e:
+            logger.error(f"Failed to load proxies: {e}")
+            return
+        if proxies is None:
+            proxies = []
+        async with self.cond:
+            self.apply_proxy_list(proxies)
+
+    async def add_proxies(self):
+        proxies = await self.load_proxy_list()
+        if proxies is None:
+            return
+        async with self.cond:
+            self.apply_proxy_list(proxies)
 
-        random_shuffle(self.dispatcher_queue)
+    async def watch_proxies(self):
+        # picks up edits to proxies.json and refreshes proxyFetchUrl, without dropping requests in flight
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                mtime = os.path.getmtime(self.proxies_file) if os.path.isfile(self.proxies_file) else None
+                fetch_due = self.proxy_fetch_url is not None and time.monotonic() - self.last_proxy_fetch > self.proxy_fetch_interval
+                if mtime != self.proxies_mtime or fetch_due:
+                    self.proxies_mtime = mtime
+                    await self.reload_proxies()
+            except Exception as e:
+                logger.error(f"Error while watching proxies: {e}")
+
+    async def probe(self, dispatcher_id: int, dispatcher: Optional[EggProxy]) -> bool:
+        proxy_args = {} if dispatcher is None else {
+            "proxy": dispatcher.url,
+            "proxy_auth": dispatcher.auth
+        }
+        start = time.monotonic()
+        ok = False
+        try:
+            async with self.session_for(dispatcher_id).get(self.probe_url, timeout=self.probe_timeout, **proxy_args) as resp:
+                await resp.read()
+                ok = resp.status < 500
+        except Exception:
+            ok = False
+        self.health_of(dispatcher_id).record(ok, time.monotonic() - start, self.health_alpha)
+        return ok
+
+    async def probe_all(self):
+        now = time.monotonic()
+        targets = []
+        async with self.cond:
+            for dispatcher_id in list(self.parked):
+                targets.append((dispatcher_id, self.pool.get(dispatcher_id), True))
+            for dispatcher_id in list(self.dispatchers):
+                # only free dispatchers that user traffic hasn't touched in a while
+                if now - self.health_of(dispatcher_id).last_used > self.probe_interval:
+                    targets.append((dispatcher_id, self.dispatchers.pop(dispatcher_id), False))
+
+        async def run(dispatcher_id: int, dispatcher: Optional[EggProxy], was_parked: bool):
+            ok = await self.probe(dispatcher_id, dispatcher)
+            if was_parked:
+                if ok and self.health_of(dispatcher_id).latency <= self.max_latency:
+                    async with self.cond:
+                        if dispatcher_id not in self.parked:
+                            # removed by a reload while we were probing
+                            self.retired.discard(dispatcher_id)
+                            self.drop_session(dispatcher_id)
+                            return
+                        self.parked.discard(dispatcher_id)
+                        self.health[dispatcher_id] = ProxyHealth()
+                        self.dispatchers[dispatcher_id] = dispatcher
+                        self.dispatcher_queue.append(dispatcher_id)
+                        self.cond.notify_all()
+                    logger.info(f"dispatcher {dispatcher_id} is healthy again")
+                return
+            await self.__add_later(dispatcher_id, dispatcher, not ok)
+
+        await asyncio.gather(*(run(*target) for target in targets), return_exceptions=True)
+
+    async def probe_loop(self):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error(f"Error while probing proxies: {e}")
+
+    def start_background(self):
+        self.tasks.add(asyncio.create_task(self.watch_proxies()))
+        self.tasks.add(asyncio.create_task(self.probe_loop()))
 
     async def close(self):
         await self.client.close()
+        for session in self.sessions.values():
+            await session.close()
         for task in self.tasks:
             task.cancel()
 
@@ -100,6 +450,19 @@ class EggFetch:
             await asyncio.sleep(wait)
             await self.cond.acquire()
 
+            if dispatcher_id in self.retired:
+                self.retired.discard(dispatcher_id)
+                self.drop_session(dispatcher_id)
+                return
+
+            health = self.health_of(dispatcher_id)
+            active = len(self.pool) - len(self.parked)
+            if health.bad(self.min_success, self.max_latency) and active > 1:
+                # keep it out of rotation until the prober sees it working again
+                self.parked.add(dispatcher_id)
+                logger.info(f"parking dispatcher {dispatcher_id} (success {health.success:.2f}, latency {health.latency:.1f}s)")
+                return
+
             self.dispatcher_queue.append(dispatcher_id)
             if dispatcher_id in self.dispatchers:
                 raise RuntimeError("dispatcher already in self.dispatchers. inconceivable!")
@@ -108,66 +471,255 @@ class EggFetch:
             # maybe some ppl are waiting for main, so everyone needs to check 🤡
             self.cond.notify_all()
 
-    async def fetch[T](self, transform: Callable[[aiohttp.ClientResponse], Awaitable[T]], *args, **kwargs: Unpack[EggFetchOptions]) -> T:
-        for _retry_i in range(self.max_retry):
-            async with self.cond:
-                if kwargs.get("noproxy", False):
-                    await self.cond.wait_for(lambda: self.main_id in self.dispatchers)
-                    dispatcher = self.dispatchers.pop(self.main_id)
-                    dispatcher_id = self.main_id
-                else:
-                    dispatcher_id = None
-                    while dispatcher_id is None:
-                        if len(self.dispatcher_queue)>0:
-                            dispatcher_id = self.dispatcher_queue.popleft()
-                            if dispatcher_id in self.dispatchers:
-                                continue
-                        else:
-                            await self.cond.wait()
-
-                    dispatcher = self.dispatchers.pop(dispatcher_id)
-
-            if _retry_i>0:
-                logger.info(f"retrying {",".join(list(args))} {_retry_i}")
-
-            err = None
+    def queue_depth(self, priority: str = "background") -> int:
+        # callers waiting for a dispatcher at this priority or a more important one
+        return sum(self.waiting[:priorities[priority] + 1])
+
+    def free_dispatchers(self) -> int:
+        return len(self.dispatchers)
+
+    def estimated_wait(self, priority: str = "interactive") -> float:
+        ahead = self.queue_depth(priority)
+        if ahead < self.free_dispatchers():
+            return 0.0
+        active = max(1, len(self.pool) - len(self.parked))
+        latencies = [h.latency for i, h in self.health.items() if i in self.pool and h.samples > 0]
+        latency = sum(latencies) / len(latencies) if latencies else 1.0
+        # each dispatcher serves one request per (latency + cooldown)
+        return (ahead + 1 - self.free_dispatchers()) * (latency + self.dispatcher_wait) / active
+
+    def breaker_for(self, endpoint: str) -> CircuitBreaker:
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker()
+        return self.breakers[endpoint]
+
+    async def breaker_state(self, endpoint: Optional[str] = None) -> str:
+        # the worst state over every endpoint if none is given
+        if endpoint is not None:
+            return self.breaker_for(endpoint).state
+        states = {b.state for b in self.breakers.values()}
+        for state in ("open", "half_open"):
+            if state in states:
+                return state
+        return "closed"
+
+    async def admit(self, priority: str = "interactive", max_wait: Optional[float] = None, endpoint: Optional[str] = None):
+        # raises Overloaded instead of letting a command queue behind everyone else
+        if endpoint is not None:
+            breaker = self.breaker_for(endpoint)
+            if breaker.state == "open":
+                raise CircuitOpen(endpoint, breaker.retry_in())
+        eta = self.estimated_wait(priority)
+        if self.queue_depth(priority) >= self.max_queue_depth or eta > (max_wait if max_wait is not None else self.max_admit_wait):
+            raise Overloaded(eta)
+
+    async def stats(self) -> dict:
+        return {"queue_depth": self.queue_depth(), "free_dispatchers": self.free_dispatchers(), "estimated_wait": self.estimated_wait(),
+                "hedges": self.hedges, "hedge_wins": self.hedge_wins}
+
+    def outranked(self, priority: int) -> bool:
+        return any(self.waiting[:priority])
+
+    async def acquire(self, priority: int, noproxy: bool, wait: bool = True, expires: Optional[float] = None, endpoint: str = "") -> Optional[tuple[int, Optional[EggProxy]]]:
+        # takes a dispatcher out of rotation, without wait only if one is free right now (None otherwise).
+        # A caller still waiting at expires (loop time) leaves the queue with DeadlineExceeded
+        async with self.cond:
+            if noproxy:
+                if not wait and self.main_id not in self.dispatchers:
+                    return None
+                try:
+                    async with asyncio.timeout_at(expires):
+                        await self.cond.wait_for(lambda: self.main_id in self.dispatchers)
+                except TimeoutError:
+                    raise DeadlineExceeded(endpoint) from None
+                return self.main_id, self.dispatchers.pop(self.main_id)
+            dispatcher_id = None
+            self.waiting[priority] += 1
             try:
-                proxy_args = {} if dispatcher is None else {
-                    "proxy": dispatcher.url,
-                    "proxy_auth": dispatcher.auth
-                }
-
-                proxy_args.update(kwargs)
-
-                async with self.client.request(
+                while dispatcher_id is None:
+                    # more important callers go first
+                    if len(self.dispatcher_queue)>0 and not self.outranked(priority):
+                        dispatcher_id = self.dispatcher_queue.popleft()
+                        # stale entry (taken by the prober or removed by a reload)
+                        if dispatcher_id not in self.dispatchers:
+                            dispatcher_id = None
+                    elif not wait:
+                        return None
+                    else:
+                        try:
+                            async with asyncio.timeout_at(expires):
+                                await self.cond.wait()
+                        except TimeoutError:
+                            raise DeadlineExceeded(endpoint) from None
+            finally:
+                self.waiting[priority] -= 1
+                # someone less important may have been held back by us
+                if len(self.dispatcher_queue)>0:
+                    self.cond.notify_all()
+            return dispatcher_id, self.dispatchers.pop(dispatcher_id)
+
+    async def attempt[T](self, transform: Callable[[aiohttp.ClientResponse], Awaitable[T]], args: tuple, kwargs: dict,
+                         dispatcher_id: int, dispatcher: Optional[EggProxy], trace: tuple) -> tuple[str, Any]:
+        # one request on one dispatcher, which goes back into rotation after its cooldown.
+        # -> (outcome, result or exception), outcome as in TrafficRecorder
+        span_name, request_id, retry_i, priority, queued_at, queued, hedge = trace
+        err = None
+        outcome = "cancelled"
+        start = time.monotonic()
+        try:
+            proxy_args = {} if dispatcher is None else {
+                "proxy": dispatcher.url,
+                "proxy_auth": dispatcher.auth
+            }
+
+            # EggFetchOptions are for us, the rest goes to aiohttp
+            proxy_args.update({k: v for k, v in kwargs.items() if k not in EggFetchOptions.__annotations__})
+
+            with tracing.span("cf", span_name):
+                async with self.session_for(dispatcher_id).request(
                     kwargs.get("method", "GET"),
                     *args,
-                    timeout=self.timeout,
                     **proxy_args
                 ) as resp:
                     if resp.status == 429 and 'Retry-After' in resp.headers:
+                        outcome = "429"
                         await asyncio.sleep(float(resp.headers['Retry-After']))
-                        continue
+                        return outcome, None
+
+                    ret = await transform(resp)
+                    outcome = "ok"
+                    self.latencies.setdefault(span_name, deque(maxlen=self.latency_samples)).append(time.monotonic() - start)
+                    return outcome, ret
+
+        except Exception as e:
+            err = e
+            outcome = "err"
+            # no point retrying an actual api error
+            if isinstance(err, CFError):
+                outcome = "down" if err.unavailable else "cf"
+            return outcome, err
+
+        finally:
+            # codeforces saying no isn't the proxy's fault. An attempt cancelled before it finished (the
+            # losing side of a hedge, or past its deadline) was too slow, which counts against the proxy
+            ok = outcome != "cancelled" and (err is None or isinstance(err, CFError))
+            self.health_of(dispatcher_id).record(ok, time.monotonic() - start, self.health_alpha)
+            if self.recorder is not None:
+                self.recorder.record(
+                    round(queued_at, 3), request_id, retry_i, span_name, priority, int(kwargs.get("noproxy", False)),
+                    dispatcher_id, round(start - queued, 3), round(time.monotonic() - start, 3), outcome, int(hedge)
+                )
+            self.tasks.add(asyncio.create_task(
+                self.__add_later(dispatcher_id, dispatcher, err is not None)
+            ))
+
+    def hedge_delay(self, endpoint: str) -> float:
+        # hedge_percentile of the endpoint's recent successful attempts
+        samples = self.latencies.get(endpoint)
+        if samples is None or len(samples) < self.hedge_min_samples:
+            return self.hedge_default_delay
+        ordered = sorted(samples)
+        return max(self.hedge_min_delay, ordered[min(len(ordered) - 1, int(self.hedge_percentile * len(ordered)))])
+
+    def take_hedge(self) -> bool:
+        if self.hedge_tokens < 1:
+            return False
+        self.hedge_tokens -= 1
+        return True
+
+    async def hedged[T](self, transform: Callable[[aiohttp.ClientResponse], Awaitable[T]], args: tuple, kwargs: dict,
+                        dispatcher_id: int, dispatcher: Optional[EggProxy], trace: tuple) -> tuple[str, Any]:
+        # attempt(), plus a second one on another free dispatcher if the first is still running after
+        # hedge_delay. Whichever succeeds first wins and the other is cancelled
+        span_name, _, _, priority, _, _, _ = trace
+        self.hedge_tokens = min(self.hedge_burst, self.hedge_tokens + self.hedge_budget)
+        pending = {asyncio.create_task(self.attempt(transform, args, kwargs, dispatcher_id, dispatcher, trace))}
+        results = []
+        backup = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_delay(span_name))
+            if not done and self.take_hedge():
+                second = await self.acquire(priority, False, wait=False)
+                if second is None:
+                    # nothing idle, the hedge would only queue behind other requests
+                    self.hedge_tokens += 1
+                else:
+                    self.hedges += 1
+                    hedge_trace = trace[:3] + (priority, time.time(), time.monotonic(), True)
+                    backup = asyncio.create_task(self.attempt(transform, args, kwargs, *second, hedge_trace))
+                    pending.add(backup)
+            while True:
+                for task in done:
+                    outcome, value = task.result()
+                    if outcome == "ok":
+                        if task is backup:
+                            self.hedge_wins += 1
+                        return outcome, value
+                    results.append((outcome, value))
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        # an api error is final, otherwise any failure will do for the retry loop
+        return next((r for r in results if r[0] in ("cf", "down")), results[0])
+
+    def expiry(self, kwargs: dict) -> Optional[float]:
+        # the request's deadline and budget as one loop time (None for no limit)
+        remaining = kwargs.get("budget")
+        if kwargs.get("deadline") is not None:
+            left = kwargs["deadline"] - time.time()
+            remaining = left if remaining is None else min(remaining, left)
+        return None if remaining is None else asyncio.get_running_loop().time() + remaining
 
-                    return await transform(resp)
+    async def fetch[T](self, transform: Callable[[aiohttp.ClientResponse], Awaitable[T]], *args, **kwargs: Unpack[EggFetchOptions]) -> T:
+        span_name = args[0].split("?")[0].rsplit("/", 1)[-1]
+        priority = priorities[kwargs.get("priority") or "interactive"]
+        noproxy = kwargs.get("noproxy", False)
+        expires = self.expiry(kwargs)
+        loop = asyncio.get_running_loop()
+        request_id = next(self.recorder.ids) if self.recorder is not None else None
+        err = None
+        for _retry_i in range(self.max_retry):
+            if expires is not None and loop.time() >= expires:
+                raise DeadlineExceeded(span_name)
+            queued_at = time.time()
+            queued = time.monotonic()
+            with tracing.span("cf_queue", span_name):
+                dispatcher_id, dispatcher = await self.acquire(priority, noproxy, expires=expires, endpoint=span_name)
 
-            except Exception as e:
-                err = e
-                # break if an actual api error, since retrying doesn't change anything
-                if isinstance(err, CFError):
-                    break
+            if _retry_i>0:
+                logger.info(f"retrying {",".join(list(args))} {_retry_i}")
 
-            finally:
-                self.tasks.add(asyncio.create_task(
-                    self.__add_later(dispatcher_id, dispatcher, err is not None)
-                ))
+            trace = (span_name, request_id, _retry_i, priority, queued_at, queued, False)
+            try:
+                # the attempt (and a 429's Retry-After) is cut short at the deadline as well
+                async with asyncio.timeout_at(expires):
+                    # the main dispatcher is the only one without a proxy, there's nothing to hedge onto
+                    if kwargs.get("hedge") and not noproxy:
+                        outcome, value = await self.hedged(transform, args, kwargs, dispatcher_id, dispatcher, trace)
+                    else:
+                        outcome, value = await self.attempt(transform, args, kwargs, dispatcher_id, dispatcher, trace)
+            except TimeoutError:
+                raise DeadlineExceeded(span_name) from None
+            if outcome == "ok":
+                return value
+            if outcome == "429":
+                continue
+            err = value
+            # break if an actual api error, since retrying doesn't change anything
+            if outcome in ("cf", "down"):
+                break
 
         logger.info(f"ran out of retries for request {args[0]}", err)
         raise err
 
     cf_base_url = "https://codeforces.com/api/"
 
-    async def codeforces[T](self, endpoint: str, params: Optional[Dict[str, str]] = None) -> T:
+    async def codeforces[T](self, endpoint: str, params: Optional[Dict[str, str]] = None, **kwargs: Unpack[EggFetchOptions]) -> T:
         url = urljoin(self.cf_base_url, endpoint)
         if params:
             url += f"?{urlencode(params)}"
@@ -178,7 +730,7 @@ class EggFetch:
                 try:
                     r = json.loads(txt)
                 except json.JSONDecodeError as e:
-                    raise CFError(f"{txt}") from e
+                    raise CFError(f"{txt}", unavailable=resp.status >= 500) from e
             else:
                 r = await resp.json()
 
@@ -190,9 +742,75 @@ class EggFetch:
 
             return r
 
-        return await self.fetch(transform, url)
+        breaker = self.breaker_for(endpoint)
+        if not breaker.allow():
+            raise CircuitOpen(endpoint, breaker.retry_in())
+        ok = None
+        try:
+            r = await self.fetch(transform, url, **kwargs)
+            ok = True
+            return r
+        except CFError as e:
+            # an api error means codeforces is up and answering
+            ok = not e.unavailable
+            raise
+        except DeadlineExceeded:
+            # the caller stopped waiting, which says nothing about codeforces
+            raise
+        except Exception:
+            ok = False
+            raise
+        finally:
+            breaker.record(ok)
+
+    async def extract(self, name: str, endpoint: str, params: Optional[Dict[str, str]] = None, **kwargs: Unpack[EggFetchOptions]) -> Any:
+        response_data = await self.codeforces(endpoint, params, **kwargs)
+        return extractors[name](response_data["result"])
+
+def problem_id(problem: dict) -> str:
+    return f"{problem['contestId']}{problem['index']}"
+
+# compact views of the big responses, so the fetch worker only has to send back what callers use
+
+def extract_problems(result: dict) -> list:
+    return [{
+        "contestId": p["contestId"],
+        "index": p["index"],
+        "name": p["name"],
+        "rating": p.get("rating"),
+        "tags": p.get("tags", [])
+    } for p in result["problems"] if "*special" not in p.get("tags", [])]
+
+def extract_submissions(result: list) -> list:
+    # (id, creationTimeSeconds, problem id or None, verdict), newest first like the api
+    return [(
+        sub["id"],
+        sub["creationTimeSeconds"],
+        problem_id(sub["problem"]) if "contestId" in sub else None,
+        sub.get("verdict")
+    ) for sub in result]
+
+def extract_solved(result: list) -> dict:
+    last = [0, 0]
+    solved = set()
+    for sub in result:
+        if sub.get("verdict") == "OK" and "contestId" in sub:
+            solved.add(problem_id(sub["problem"]))
+            if sub["creationTimeSeconds"] > last[0]:
+                last = [sub["creationTimeSeconds"], sub["id"]]
+    return {"last": last, "solved": sorted(solved)}
+
+extractors: dict[str, Callable[[Any], Any]] = {
+    "problems": extract_problems,
+    "submissions": extract_submissions,
+    "solved": extract_solved
+}
 
 async def eggfetch():
     ret = EggFetch()
     await ret.add_proxies()
+    if config.get("traffic_record", False):
+        ret.recorder = TrafficRecorder(config.get("traffic_path", config.path + "traffic.jsonl"))
+        ret.recorder.header(ret)
+    ret.start_background()
     return ret
\ No newline at end of file
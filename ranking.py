@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from bisect import bisect_left, insort
+
+import shards
+import tracing
+from exceptions import DatabaseError
+
+logger = logging.getLogger("bot_logger.ranking")
+
+# ratings outside this range are clamped for indexing (never happens with the current formula)
+min_rating = -4096
+max_rating = 8191
+size = max_rating - min_rating + 1
+
+def clamp(rating: int):
+    return min(max_rating, max(min_rating, rating))
+
+class GuildRanking:
+    # Fenwick tree over the rating range counting users per rating, plus the users at each
+    # rating sorted by id (ties are ordered by user id), so rank lookups and pages are O(log n)
+    def __init__(self):
+        self.tree = [0] * (size + 1)
+        self.ratings: dict[int, int] = {}
+        self.buckets: dict[int, list[int]] = {}
+        self.total = 0
+        self.loaded = False
+        # changes that happened while the guild was being loaded, None means removed
+        self.pending: dict[int, int | None] = {}
+
+    def _add(self, rating: int, delta: int):
+        i = clamp(rating) - min_rating + 1
+        while i <= size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, rating: int):
+        # users with rating <= rating
+        i = clamp(rating) - min_rating + 1
+        s = 0
+        while i > 0:
+            s += self.tree[i]
+            i -= i & -i
+        return s
+
+    def _lower_bound(self, target: int):
+        # smallest rating with _prefix(rating) >= target
+        pos = 0
+        step = 1 << size.bit_length()
+        while step > 0:
+            if pos + step <= size and self.tree[pos + step] < target:
+                pos += step
+                target -= self.tree[pos]
+            step >>= 1
+        return pos + min_rating
+
+    def set(self, user_id: int, rating: int):
+        self.remove(user_id)
+        rating = clamp(rating)
+        self.ratings[user_id] = rating
+        insort(self.buckets.setdefault(rating, []), user_id)
+        self._add(rating, 1)
+        self.total += 1
+
+    def remove(self, user_id: int):
+        rating = self.ratings.pop(user_id, None)
+        if rating is None:
+            return
+        bucket = self.buckets[rating]
+        bucket.pop(bisect_left(bucket, user_id))
+        if not bucket:
+            del self.buckets[rating]
+        self._add(rating, -1)
+        self.total -= 1
+
+    def count_above(self, rating: int):
+        return self.total - self._prefix(rating)
+
+    def rank(self, user_id: int):
+        # 1-based, None if the user isn't ranked
+        rating = self.ratings.get(user_id)
+        if rating is None:
+            return None
+        return self.count_above(rating) + bisect_left(self.buckets[rating], user_id) + 1
+
+    def page(self, start: int, count: int):
+        # [(rank, user_id, rating)] for ranks start + 1 .. start + count
+        ret = []
+        k = max(0, start)
+        while len(ret) < count and k < self.total:
+            rating = self._lower_bound(self.total - k)
+            bucket = self.buckets[rating]
+            offset = k - self.count_above(rating)
+            for user_id in bucket[offset:offset + count - len(ret)]:
+                ret.append((k + 1, user_id, rating))
+                k += 1
+        return ret
+
+    def around(self, user_id: int, radius: int):
+        rank = self.rank(user_id)
+        if rank is None:
+            return []
+        start = max(0, rank - 1 - radius)
+        return self.page(start, rank - start + radius)
+
+rankings: dict[int, GuildRanking] = {}
+load_locks: dict[int, asyncio.Lock] = {}
+
+@tracing.traced("db")
+async def load(server_id: int, ranking: GuildRanking):
+    try:
+        async with shards.connect(server_id) as db:
+            async with db.execute("SELECT user_id, rating FROM users WHERE server_id = ?", (server_id,)) as cursor:
+                rows = await cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Database error, ranking load(): {e}")
+        raise DatabaseError(e)
+    for user_id, rating in rows:
+        ranking.set(user_id, rating)
+    for user_id, rating in ranking.pending.items():
+        if rating is None:
+            ranking.remove(user_id)
+        else:
+            ranking.set(user_id, rating)
+    ranking.pending.clear()
+    ranking.loaded = True
+
+async def get_ranking(server_id: int) -> GuildRanking:
+    ranking = rankings.get(server_id)
+    if ranking is not None and ranking.loaded:
+        return ranking
+    lock = load_locks.setdefault(server_id, asyncio.Lock())
+    async with lock:
+        ranking = rankings.get(server_id)
+        if ranking is None:
+            ranking = GuildRanking()
+            rankings[server_id] = ranking
+        if not ranking.loaded:
+            try:
+                await load(server_id, ranking)
+            except Exception:
+                rankings.pop(server_id, None)
+                raise
+        return ranking
+
+# called after the matching database write commits (update_rating, validate_handle, unlink)
+
+def update(server_id: int, user_id: int, rating: int):
+    ranking = rankings.get(server_id)
+    if ranking is None:
+        return
+    if ranking.loaded:
+        ranking.set(user_id, rating)
+    else:
+        ranking.pending[user_id] = rating
+
+def remove(server_id: int, user_id: int):
+    ranking = rankings.get(server_id)
+    if ranking is None:
+        return
+    if ranking.loaded:
+        ranking.remove(user_id)
+    else:
+        ranking.pending[user_id] = None
@@ -0,0 +1,173 @@
+import io
+import logging
+
+import config
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+logger = logging.getLogger("bot_logger.rating_chart")
+
+# Draws the =rating chart with Pillow: rank bands, the line, markers, ticks and a title, without
+# matplotlib's import and figure setup. matplotlib is only imported if Pillow isn't available (or
+# chart_backend says so).
+
+width, height = 640, 480
+left, right, top, bottom = 56, 16, 36, 32
+# drawn this much larger and scaled down, Pillow doesn't antialias lines
+scale = 2
+# longer histories are bucketed down to about this many points, keeping each bucket's min and max
+max_points = 240
+# markers only while they don't overlap
+max_markers = 60
+
+# (low, high, color, alpha) like codeforces' rank colors
+bands = [
+    (-1000, 1200, (128, 128, 128), 0.5),
+    (1200, 1400, (0, 255, 0), 0.5),
+    (1400, 1600, (0, 255, 255), 0.5),
+    (1600, 1900, (0, 0, 255), 0.5),
+    (1900, 2100, (128, 0, 128), 0.5),
+    (2100, 2300, (255, 255, 0), 0.5),
+    (2300, 2400, (255, 165, 0), 0.7),
+    (2400, 2600, (255, 0, 0), 0.7),
+    (2600, 3000, (255, 192, 203), 0.9),
+    (3000, 5000, (255, 0, 255), 0.7)
+]
+rating_ticks = [0, 1200, 1400, 1600, 1900, 2100, 2300, 2400, 2600, 3000]
+line_color = (0, 0, 255)
+axis_color = (0, 0, 0)
+background = (255, 255, 255)
+
+def blend(color: tuple, alpha: float):
+    return tuple(round(c * alpha + b * (1 - alpha)) for c, b in zip(color, background))
+
+band_colors = [(low, high, blend(color, alpha)) for low, high, color, alpha in bands]
+
+fonts = {}
+
+def font(size: int):
+    if size not in fonts:
+        try:
+            fonts[size] = ImageFont.load_default(size=size)
+        except Exception:
+            # no freetype, the bitmap font only comes in one size
+            fonts[size] = ImageFont.load_default()
+    return fonts[size]
+
+def downsample(xs: list, ys: list, limit: int):
+    # min/max per bucket, so every peak and dip of a long history still shows up
+    n = len(ys)
+    if n <= limit:
+        return xs, ys
+    buckets = max(1, (limit - 2) // 2)
+    size = (n - 2) / buckets
+    rx, ry = [xs[0]], [ys[0]]
+    for b in range(buckets):
+        lo = 1 + int(b * size)
+        hi = min(n - 1, 1 + int((b + 1) * size))
+        if lo >= hi:
+            continue
+        i_min = min(range(lo, hi), key=ys.__getitem__)
+        i_max = max(range(lo, hi), key=ys.__getitem__)
+        for i in sorted({i_min, i_max}):
+            rx.append(xs[i])
+            ry.append(ys[i])
+    rx.append(xs[-1])
+    ry.append(ys[-1])
+    return rx, ry
+
+def tick_step(count: int, most: int = 12):
+    step = 1
+    while True:
+        for m in (1, 2, 5):
+            if count / (step * m) <= most:
+                return step * m
+        step *= 10
+
+def x_ticks(count: int):
+    step = tick_step(count)
+    return [1] + list(range(step, count + 1, step)) if step > 1 else list(range(1, count + 1))
+
+def render_pillow(history: list, title: str) -> io.BytesIO:
+    s = scale
+    img = Image.new("RGB", (width * s, height * s), background)
+    draw = ImageDraw.Draw(img)
+    x0, x1, y0, y1 = left * s, (width - right) * s, top * s, (height - bottom) * s
+    lo, hi = min(history) - 100, max(history) + 100
+    n = len(history)
+
+    def px(x: float):
+        return x0 + (x - 1) / (n - 1) * (x1 - x0) if n > 1 else (x0 + x1) / 2
+
+    def py(y: float):
+        return y1 - (y - lo) / (hi - lo) * (y1 - y0)
+
+    for band_lo, band_hi, color in band_colors:
+        if band_hi <= lo or band_lo >= hi:
+            continue
+        draw.rectangle((x0, py(min(band_hi, hi)), x1, py(max(band_lo, lo))), fill=color)
+
+    small = font(11 * s)
+    tick = 4 * s
+    last = None
+    for r in rating_ticks:
+        if lo <= r <= hi:
+            y = py(r)
+            # bands get thin on a tall chart, skip labels that would overlap
+            if last is not None and last - y < 14 * s:
+                continue
+            last = y
+            draw.line((x0 - tick, y, x0, y), fill=axis_color, width=s)
+            draw.text((x0 - tick - 2 * s, y), str(r), fill=axis_color, font=small, anchor="rm")
+    for x in x_ticks(n):
+        draw.line((px(x), y1, px(x), y1 + tick), fill=axis_color, width=s)
+        draw.text((px(x), y1 + tick + 2 * s), str(x), fill=axis_color, font=small, anchor="mt")
+    draw.rectangle((x0, y0, x1, y1), outline=axis_color, width=s)
+
+    xs, ys = downsample(list(range(1, n + 1)), history, max_points)
+    points = [(px(x), py(y)) for x, y in zip(xs, ys)]
+    if len(points) > 1:
+        draw.line(points, fill=line_color, width=2 * s, joint="curve")
+    if len(points) <= max_markers:
+        r = 3 * s
+        for x, y in points:
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=line_color)
+
+    draw.text(((x0 + x1) / 2, y0 / 2), title, fill=axis_color, font=font(14 * s), anchor="mm")
+
+    img = img.reduce(s)
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG", compress_level=1)
+    buffer.seek(0)
+    return buffer
+
+def render_matplotlib(history: list, title: str) -> io.BytesIO:
+    # the old chart, the Figure api doesn't need pyplot's global state
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    ax = fig.subplots()
+    for low, high, color, alpha in bands:
+        ax.axhspan(low, high, facecolor=tuple(c / 255 for c in color), alpha=alpha)
+    xs, ys = downsample(list(range(1, len(history) + 1)), history, max_points)
+    ax.plot(xs, ys, marker="o" if len(xs) <= max_markers else None, linestyle="-", color="blue", markersize=6)
+    ax.set_ylim(min(history) - 100, max(history) + 100)
+    ax.set_yticks([r for r in rating_ticks if min(history) - 100 <= r <= max(history) + 100])
+    ax.set_xticks(x_ticks(len(history)))
+    ax.set_title(title)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", bbox_inches="tight")
+    buffer.seek(0)
+    return buffer
+
+def render(history: list, title: str) -> io.BytesIO:
+    # png of the rating history (oldest first)
+    if Image is not None and config.get("chart_backend", "pillow") != "matplotlib":
+        try:
+            return render_pillow(history, title)
+        except Exception as e:
+            logger.error(f"Pillow chart failed, falling back to matplotlib: {e}")
+    return render_matplotlib(history, title)
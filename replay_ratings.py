@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import asyncio
+import argparse
+import numpy as np
+
+import util
+import proxy
+import shards
+
+# Replays every stored challenge with the current util.get_rating_changes formula and shows
+# (or writes) the recomputed ratings. Each user's rating only depends on their own challenges,
+# so step k settles the k-th challenge of every user at once.
+
+lengths = (80, 60, 40)
+
+def get_rating_changes_np(old_rating: np.ndarray, problem_rating: np.ndarray, length: np.ndarray):
+    # util.get_rating_changes over whole arrays, keep the two in sync
+    problem_rating = problem_rating + 50 * ((80 - length) / 20)
+    magnitude = 16
+    e = 1 + np.power(10.0, (problem_rating - old_rating) / 500)
+    with np.errstate(divide="ignore", over="ignore"):
+        lose = -np.minimum(magnitude * 10, np.floor_divide(0.5 * magnitude, 1 - (1 / e)))
+        win = np.minimum(magnitude * 10, np.floor_divide(0.5 * magnitude, 1.15 / e))
+    return [lose.astype(np.int64), win.astype(np.int64)]
+
+def infer_lengths(length: np.ndarray, before: np.ndarray, delta: np.ndarray, prob: np.ndarray, known: np.ndarray):
+    # challenges from before lengths were stored, find the one that explains each recorded change (0 if none does)
+    for l in lengths:
+        lose, win = get_rating_changes_np(before.astype(np.float64), prob, np.full(prob.shape, l, dtype=np.float64))
+        match = known & (length == 0) & ((delta == lose) | (delta == win))
+        length[match] = l
+    return length
+
+def load_users(conn: sqlite3.Connection, guild):
+    query = "SELECT server_id, user_id, handle, rating, history, rating_history FROM users"
+    if guild is not None:
+        return conn.execute(query + " WHERE server_id = ?", (guild,)).fetchall()
+    return conn.execute(query).fetchall()
+
+def load_lengths(conn: sqlite3.Connection, guild):
+    query = "SELECT server_id, user_id, seq, length FROM challenges WHERE length IS NOT NULL"
+    rows = conn.execute(query + " AND server_id = ?", (guild,)) if guild is not None else conn.execute(query)
+    stored = {}
+    for server_id, user_id, seq, length in rows:
+        stored.setdefault((server_id, user_id), {})[seq] = length
+    return stored
+
+def build_matrices(users: list, problem_ratings: dict, stored_lengths: dict):
+    n = len(users)
+    width = max([len(json.loads(u[4])) for u in users] + [0])
+    start = np.full(n, 1500, dtype=np.int64)
+    prob = np.zeros((n, width), dtype=np.float64)
+    before = np.zeros((n, width), dtype=np.int64)
+    delta = np.zeros((n, width), dtype=np.int64)
+    mask = np.zeros((n, width), dtype=bool)
+    known = np.zeros((n, width), dtype=bool)
+    length = np.zeros((n, width), dtype=np.float64)
+    for i, u in enumerate(users):
+        history = json.loads(u[4])
+        rating_history = json.loads(u[5])
+        if rating_history:
+            start[i] = rating_history[0]
+        k = min(len(history), len(rating_history) - 1)
+        if k <= 0:
+            continue
+        rh = np.asarray(rating_history[:k + 1], dtype=np.int64)
+        before[i, :k] = rh[:-1]
+        delta[i, :k] = np.diff(rh)
+        mask[i, :k] = True
+        for j in range(k):
+            r = problem_ratings.get(history[j])
+            if r is not None:
+                prob[i, j] = r
+                known[i, j] = True
+        for j, l in stored_lengths.get((u[0], u[1]), {}).items():
+            if j < k:
+                length[i, j] = l
+    length = infer_lengths(length, before, delta, prob, known)
+    solved = delta > 0
+    # challenges we can't recompute (problem gone from the catalog, or a change no length explains) keep their recorded change
+    fixed = mask & ((length == 0) | ~known)
+    length[length == 0] = 80
+    return start, prob, length, solved, mask, fixed, delta, int(fixed.sum())
+
+def replay(start, prob, length, solved, mask, fixed, fixed_delta):
+    n, width = prob.shape
+    rating = start.copy()
+    history = np.zeros((n, width + 1), dtype=np.int64)
+    history[:, 0] = rating
+    for k in range(width):
+        lose, win = get_rating_changes_np(rating.astype(np.float64), prob[:, k], length[:, k])
+        delta = np.where(fixed[:, k], fixed_delta[:, k], np.where(solved[:, k], win, lose))
+        rating = np.where(mask[:, k], rating + delta, rating)
+        history[:, k + 1] = rating
+    return rating, history
+
+def print_diff(users: list, new_rating: np.ndarray):
+    guilds = {}
+    for i, u in enumerate(users):
+        guilds.setdefault(u[0], []).append(i)
+    changed = 0
+    for guild, idx in sorted(guilds.items()):
+        old_order = sorted(idx, key=lambda i: -users[i][3])
+        new_order = sorted(idx, key=lambda i: -int(new_rating[i]))
+        old_rank = {i: r + 1 for r, i in enumerate(old_order)}
+        print(f"Guild {guild}:")
+        print(f"  {'rank':>9} {'handle':<24} {'old':>6} {'new':>6} {'diff':>6}")
+        for r, i in enumerate(new_order):
+            diff = int(new_rating[i]) - users[i][3]
+            changed += diff != 0
+            rank = f"{old_rank[i]}->{r + 1}" if old_rank[i] != r + 1 else f"{r + 1}"
+            print(f"  {rank:>9} {users[i][2]:<24} {users[i][3]:>6} {int(new_rating[i]):>6} {diff:>+6}")
+    return changed
+
+def write(conn: sqlite3.Connection, users: list, mask: np.ndarray, new_rating: np.ndarray, history: np.ndarray, global_handles: bool = True):
+    counts = mask.sum(axis=1)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for i, u in enumerate(users):
+            rating_history = history[i, :counts[i] + 1].tolist()
+            conn.execute("UPDATE users SET rating = ?, rating_history = ? WHERE server_id = ? AND user_id = ?",
+                         (int(new_rating[i]), json.dumps(rating_history), u[0], u[1]))
+            conn.executemany("UPDATE challenges SET rating_before = ?, rating_after = ? WHERE server_id = ? AND user_id = ? AND seq = ?",
+                             [(rating_history[k], rating_history[k + 1], u[0], u[1], k) for k in range(counts[i])])
+        if global_handles:
+            conn.execute("DELETE FROM global_handles")
+            conn.execute(f"INSERT INTO global_handles {util.global_handle_select} GROUP BY handle")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+async def fetch_problem_ratings():
+    egg = await proxy.eggfetch()
+    try:
+        problems = await egg.extract("problems", "problemset.problems", priority="background")
+    finally:
+        await egg.close()
+    return {f"{p['contestId']}{p['index']}": p["rating"] for p in problems if p["rating"] is not None}
+
+def load_problem_ratings(file_path: str):
+    # a saved problemset.problems response
+    with open(file_path, encoding="utf-8") as f:
+        problems = proxy.extract_problems(json.load(f)["result"])
+    return {f"{p['contestId']}{p['index']}": p["rating"] for p in problems if p["rating"] is not None}
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute ratings by replaying every stored challenge")
+    parser.add_argument("--db", default=None, help="database to use (default: bot_data.db, or every shard file with db_shards)")
+    parser.add_argument("--guild", type=int, help="only replay this server")
+    parser.add_argument("--problems", help="saved problemset.problems response to use instead of fetching it")
+    parser.add_argument("--write", action="store_true", help="write the recomputed ratings (default is a dry run)")
+    args = parser.parse_args()
+
+    # users only ever depend on their own challenges, so shard files are replayed one at a time
+    sharded = args.db is None and shards.enabled()
+    if args.db is not None:
+        files = [args.db]
+    elif args.guild is not None:
+        files = [shards.guild_path(args.guild)]
+    else:
+        files = shards.guild_paths()
+
+    problem_ratings = load_problem_ratings(args.problems) if args.problems else asyncio.run(fetch_problem_ratings())
+    total = 0
+    for file_path in files:
+        if not os.path.exists(file_path):
+            continue
+        conn = sqlite3.connect(file_path, isolation_level=None)
+        users = load_users(conn, args.guild)
+        if not users:
+            conn.close()
+            continue
+        total += len(users)
+        if sharded:
+            print(f"{shards.shard_name(file_path)}:")
+
+        t = time.perf_counter()
+        start, prob, length, solved, mask, fixed, fixed_delta, unknown = build_matrices(users, problem_ratings, load_lengths(conn, args.guild))
+        new_rating, history = replay(start, prob, length, solved, mask, fixed, fixed_delta)
+        elapsed = time.perf_counter() - t
+
+        changed = print_diff(users, new_rating)
+        print(f"Replayed {int(mask.sum())} challenges for {len(users)} users in {elapsed:.3f}s, {changed} ratings change.")
+        if unknown:
+            print(f"{unknown} challenges kept their recorded change (problem not in the catalog or no length matches).")
+
+        if args.write:
+            write(conn, users, mask, new_rating, history, global_handles=not sharded)
+        conn.close()
+
+    if not total:
+        print("No users.")
+        return 0
+    if args.write:
+        if sharded:
+            shards.rebuild_global()
+        print("Written.")
+    else:
+        print("Dry run, use --write to save.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
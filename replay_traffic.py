@@ -0,0 +1,265 @@
+import json
+import math
+import asyncio
+import argparse
+import selectors
+from collections import deque
+from dataclasses import dataclass, field
+
+import config
+import proxy
+from proxy import CFError, EggFetch, EggProxy
+
+# Replays a traffic recording (traffic_record in config.json, see proxy.TrafficRecorder) through
+# the real EggFetch.fetch and dispatcher cooldown code, on an event loop whose clock jumps to the
+# next timer instead of sleeping. Requests arrive when they did in production and each attempt
+# takes as long and ends the same way as the recorded one, so only the scheduling changes:
+# proxy count, dispatcher_wait, dispatcher_error_wait, dispatcher_error_mul and max_retry.
+# Breakers, parking, probing and hedging aren't simulated.
+
+tunables = {"dispatcher_wait": float, "dispatcher_error_wait": float, "dispatcher_error_mul": float, "max_retry": int}
+priority_names = {v: k for k, v in proxy.priorities.items()}
+
+@dataclass
+class Request:
+    arrival: float
+    endpoint: str
+    priority: int
+    noproxy: bool
+    # (latency, outcome) per recorded attempt
+    attempts: list = field(default_factory=list)
+    recorded_waits: list = field(default_factory=list)
+
+def load(file_path: str):
+    # -> (header of the last recording session, requests ordered by arrival)
+    header = None
+    session = -1
+    requests = {}
+    with open(file_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(row, dict):
+                if row.get("type") == "traffic":
+                    header = row
+                    session += 1
+                continue
+            t, request_id, attempt, endpoint, priority, noproxy, _, wait, latency, outcome = row[:10]
+            # hedging isn't simulated, only the attempts every request made
+            if len(row) > 10 and row[10]:
+                continue
+            # request ids restart with every bot run
+            r = requests.get((session, request_id))
+            if r is None:
+                r = requests[(session, request_id)] = Request(t, endpoint, priority, bool(noproxy))
+            if attempt == 0:
+                r.arrival = t
+            r.attempts.append((attempt, latency, outcome))
+            r.recorded_waits.append(wait)
+    ordered = sorted(requests.values(), key=lambda r: r.arrival)
+    for r in ordered:
+        r.attempts = [(latency, outcome) for _, latency, outcome in sorted(r.attempts)]
+    return header, ordered
+
+class SimSelector(selectors.DefaultSelector):
+    # instead of blocking until the next timer is due, move the clock there
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError("replay stalled with nothing scheduled")
+        # always move forward, a timeout below the clock's precision would spin forever
+        self.now = max(self.now + timeout, math.nextafter(self.now, math.inf)) if timeout > 0 else self.now
+        return super().select(0)
+
+class SimLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.sim = SimSelector()
+        super().__init__(self.sim)
+
+    def time(self):
+        return self.sim.now
+
+class ReplayResponse:
+    def __init__(self, outcome: str, retry_after: float = 0.0):
+        self.outcome = outcome
+        self.status = 429 if outcome == "429" else 200
+        self.headers = {"Retry-After": str(retry_after)} if outcome == "429" else {}
+
+class ReplayRequest:
+    def __init__(self, session: "ReplaySession", index: int):
+        self.session = session
+        self.index = index
+
+    async def __aenter__(self):
+        return await self.session.serve(self.index)
+
+    async def __aexit__(self, *exc):
+        return False
+
+class ReplaySession:
+    # stands in for every dispatcher's aiohttp session, the url carries the request's index
+    def __init__(self, requests: list):
+        self.requests = requests
+        self.next_attempt = [0] * len(requests)
+        # when the current attempt started queueing for a dispatcher
+        self.ready_at = [r.arrival - requests[0].arrival for r in requests]
+        self.waits = []
+        self.attempts = 0
+
+    def request(self, method: str, url: str, **kwargs):
+        return ReplayRequest(self, int(url.rsplit("=", 1)[1]))
+
+    async def serve(self, index: int):
+        loop = asyncio.get_running_loop()
+        r = self.requests[index]
+        self.waits.append(loop.time() - self.ready_at[index])
+        self.attempts += 1
+        # more retries than were recorded end like the last recorded one
+        latency, outcome = r.attempts[min(self.next_attempt[index], len(r.attempts) - 1)]
+        self.next_attempt[index] += 1
+        self.ready_at[index] = loop.time() + latency
+        if outcome == "429":
+            # fetch sleeps for Retry-After itself
+            return ReplayResponse(outcome, latency)
+        await asyncio.sleep(latency)
+        if outcome == "err":
+            raise RuntimeError("recorded request error")
+        return ReplayResponse(outcome)
+
+async def transform(resp: ReplayResponse):
+    if resp.outcome in ("cf", "down"):
+        raise CFError("recorded api error", unavailable=resp.outcome == "down")
+    return None
+
+class SimEggFetch(EggFetch):
+    # EggFetch keeps its state on the class, every run gets its own copy here
+    min_success = 0.0
+
+    def __init__(self, proxies: int, params: dict, session: ReplaySession):
+        self.dispatchers = {self.main_id: None}
+        for i in range(1, proxies + 1):
+            self.dispatchers[i] = EggProxy(f"http://replay-proxy-{i}", None)
+        self.pool = dict(self.dispatchers)
+        self.dispatcher_queue = deque(self.dispatchers)
+        self.health = {}
+        self.sessions = {}
+        self.dispatcher_error_waits = {}
+        self.parked = set()
+        self.retired = set()
+        self.breakers = {}
+        self.waiting = [0, 0, 0]
+        self.tasks = set()
+        self.cond = asyncio.Condition()
+        self.recorder = None
+        self.latencies = {}
+        for name, value in params.items():
+            setattr(self, name, value)
+        self.session = session
+
+    def session_for(self, dispatcher_id: int):
+        return self.session
+
+async def replay(requests: list, proxies: int, params: dict):
+    loop = asyncio.get_running_loop()
+    session = ReplaySession(requests)
+    egg = SimEggFetch(proxies, params, session)
+    # simulated time starts at 0 at the first arrival
+    origin = requests[0].arrival
+    done = [None] * len(requests)
+
+    async def one(index: int, r: Request):
+        try:
+            await egg.fetch(transform, f"https://codeforces.com/api/{r.endpoint}?replay={index}",
+                            priority=priority_names.get(r.priority, "interactive"), noproxy=r.noproxy)
+            ok = True
+        except Exception:
+            ok = False
+        done[index] = (loop.time() - (r.arrival - origin), ok)
+
+    tasks = []
+    for index, r in enumerate(requests):
+        if r.arrival - origin > loop.time():
+            await asyncio.sleep(r.arrival - origin - loop.time())
+        tasks.append(asyncio.create_task(one(index, r)))
+    await asyncio.gather(*tasks)
+    end = loop.time()
+    # let the last cooldowns run out, simulated time is free
+    await asyncio.gather(*egg.tasks)
+    return {
+        "waits": session.waits,
+        "attempts": session.attempts,
+        "latencies": [d[0] for d in done],
+        "failed": sum(not d[1] for d in done),
+        "span": end
+    }
+
+def percentile(values: list, q: float):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q * (len(values) - 1)))))]
+
+def print_row(label: str, proxies, requests: int, result: dict):
+    waits = result["waits"]
+    minutes = max(result["span"], 1.0) / 60
+    print(f"{label:<40} {proxies:>7} {result['attempts']:>8} {result['failed']:>6} "
+          f"{percentile(waits, 0.5):>8.1f} {percentile(waits, 0.95):>8.1f} {percentile(waits, 0.99):>8.1f} "
+          f"{percentile(result['latencies'], 0.95):>8.1f} {(requests - result['failed']) / minutes:>9.1f}")
+
+def parse_variant(text: str):
+    # "dispatcher_wait=5 max_retry=3" -> {"dispatcher_wait": 5.0, "max_retry": 3}
+    params = {}
+    for item in text.replace(",", " ").split():
+        name, _, value = item.partition("=")
+        if name not in tunables:
+            raise argparse.ArgumentTypeError(f"unknown parameter {name}, expected one of {', '.join(tunables)}")
+        params[name] = tunables[name](value)
+    return params
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Codeforces traffic against different EggFetch settings")
+    parser.add_argument("file", nargs="?", default=config.get("traffic_path", config.path + "traffic.jsonl"))
+    parser.add_argument("--proxies", type=int, nargs="+", help="proxy counts to try (default: as recorded)")
+    parser.add_argument("--variant", type=parse_variant, action="append", default=[],
+                        help="settings to try on top of the recorded ones, e.g. \"dispatcher_wait=5 max_retry=3\" (repeatable)")
+    args = parser.parse_args()
+
+    header, requests = load(args.file)
+    if not requests:
+        print("no requests recorded")
+        return
+    recorded = {name: getattr(EggFetch, name) for name in tunables}
+    recorded.update((header or {}).get("params", {}))
+    recorded_proxies = (header or {}).get("dispatchers", 1) - 1
+
+    print(f"{len(requests)} requests over {(requests[-1].arrival - requests[0].arrival) / 60:.1f} minutes, recorded with "
+          f"{recorded_proxies} proxies and {', '.join(f'{k}={v}' for k, v in recorded.items())}")
+    print()
+    print(f"{'settings':<40} {'proxies':>7} {'attempts':>8} {'failed':>6} {'wait p50':>8} {'wait p95':>8} {'wait p99':>8} {'e2e p95':>8} {'req/min':>9}")
+    production = {
+        "waits": [w for r in requests for w in r.recorded_waits],
+        "attempts": sum(len(r.attempts) for r in requests),
+        "latencies": [sum(r.recorded_waits) + sum(a[0] for a in r.attempts) for r in requests],
+        "failed": sum(r.attempts[-1][1] not in ("ok", "cancelled") for r in requests),
+        "span": requests[-1].arrival - requests[0].arrival
+    }
+    print_row("production", recorded_proxies, len(requests), production)
+
+    variants = [("recorded", {})] + [(" ".join(f"{k}={v}" for k, v in v.items()), v) for v in args.variant]
+    for proxies in args.proxies or [recorded_proxies]:
+        for label, variant in variants:
+            params = dict(recorded, **variant)
+            loop = SimLoop()
+            try:
+                result = loop.run_until_complete(replay(requests, proxies, params))
+            finally:
+                loop.close()
+            print_row(label, proxies, len(requests), result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import json
+import time
+import asyncio
+import logging
+
+import util
+import ranking
+import shards
+import tracing
+from exceptions import DatabaseError
+
+logger = logging.getLogger("bot_logger.settlement")
+
+async def apply_rating_update(db, server_id: int, user_id: int, rating: int, problem: str, length: int = None):
+    async with db.execute("SELECT rating_history, history, rating, challenge_count, handle FROM users WHERE server_id = ? AND user_id = ?", (server_id, user_id)) as cursor:
+        row = await cursor.fetchone()
+    if not row:
+        raise RuntimeError("Peter probably unlinked his account upd")
+    rating_history = json.loads(row[0])
+    rating_history.append(rating)
+    history = json.loads(row[1])
+    history.append(problem)
+    before, seq, handle = row[2], row[3], row[4]
+    await db.execute(
+        "UPDATE users SET rating = ?, rating_history = ?, history = ?, challenge_count = ?, solved_count = solved_count + ? WHERE server_id = ? AND user_id = ?",
+        (rating, json.dumps(rating_history), json.dumps(history), seq + 1, int(rating > before), server_id, user_id)
+    )
+    await db.execute(
+        "INSERT INTO challenges (server_id, user_id, seq, problem, rating_before, rating_after, length, time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (server_id, user_id, seq, problem, before, rating, length, int(time.time()))
+    )
+    await util.refresh_global_handle(db, handle)
+
+class SettlementQueue:
+    # Rating updates that arrive within `window` seconds of each other (from any challenge) are
+    # written in one transaction. Every submit() is its own savepoint, so one challenge's
+    # updates land together or not at all, and its future resolves once the commit is done.
+    # With db_shards each shard file in the batch gets its own transaction, run concurrently.
+    window = 0.05
+
+    def __init__(self):
+        self.pending = []
+        self.scheduled = False
+        self.lock = asyncio.Lock()
+        self.tasks = set()
+
+    def submit(self, updates: list) -> asyncio.Future:
+        # updates are (server_id, user_id, new rating, problem, length)
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((updates, fut))
+        if not self.scheduled:
+            self.scheduled = True
+            task = asyncio.create_task(self.flush())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return fut
+
+    async def flush(self):
+        await asyncio.sleep(self.window)
+        async with self.lock:
+            self.scheduled = False
+            batch, self.pending = self.pending, []
+            await self.write(batch)
+
+    async def write(self, batch: list):
+        by_file = {}
+        for updates, fut in batch:
+            # a challenge only ever touches one guild
+            file_path = shards.guild_path(updates[0][0]) if updates else shards.shared_path()
+            by_file.setdefault(file_path, []).append((updates, fut))
+        await asyncio.gather(*(self.write_file(file_path, items) for file_path, items in by_file.items()))
+
+    @tracing.traced("db")
+    async def write_file(self, file_path: str, batch: list):
+        done = []
+        try:
+            async with shards.connect_path(file_path) as db:
+                await db.execute("BEGIN TRANSACTION")
+                for i, (updates, fut) in enumerate(batch):
+                    await db.execute(f"SAVEPOINT settle{i}")
+                    try:
+                        for update in updates:
+                            await apply_rating_update(db, *update)
+                        await db.execute(f"RELEASE settle{i}")
+                        done.append((updates, fut))
+                    except Exception as e:
+                        await db.execute(f"ROLLBACK TO settle{i}")
+                        await db.execute(f"RELEASE settle{i}")
+                        logger.error(f"Database error (rating update): {e}")
+                        if not fut.done():
+                            fut.set_exception(DatabaseError(e))
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Database error (settlement batch of {len(batch)}): {e}")
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(DatabaseError(e))
+            return
+
+        for updates, fut in done:
+            for server_id, user_id, rating, _, _ in updates:
+                ranking.update(server_id, user_id, rating)
+            if not fut.done():
+                fut.set_result(None)
+
+settlement_queue = SettlementQueue()
+
+def settle(updates: list) -> asyncio.Future:
+    return settlement_queue.submit(updates)
@@ -0,0 +1,346 @@
+import os
+import json
+import asyncio
+import logging
+import sqlite3
+import aiosqlite
+import contextlib
+
+import util
+import config
+import tracing
+
+logger = logging.getLogger("bot_logger.shards")
+
+# Where guild data lives. By default everything is in bot_data.db. With db_shards set, the users
+# and challenges of a guild go to their own file in shard_dir, either one per guild ("guild") or
+# one per bucket of server_id % db_shards (a number), so SQLite's single writer lock only
+# serializes writes within a file and different guilds write in parallel. bot_data.db keeps
+# what is shared between guilds: the ac cache and the global leaderboard.
+
+mode = config.get("db_shards", 0)
+shard_dir = config.get("shard_dir", None)
+# with shards, global_handles is rebuilt from per shard aggregates this long after a write
+global_window = 0.05
+
+def enabled():
+    return mode == "guild" or (isinstance(mode, int) and mode > 0)
+
+def directory():
+    return shard_dir or util.path + "shards/"
+
+def shared_path():
+    return util.path + "bot_data.db"
+
+def guild_path(server_id: int):
+    if not enabled():
+        return shared_path()
+    if mode == "guild":
+        return os.path.join(directory(), f"guild_{server_id}.db")
+    return os.path.join(directory(), f"bucket_{server_id % mode}.db")
+
+def guild_paths():
+    # every file that has users and challenges in it
+    if not enabled():
+        return [shared_path()]
+    if not os.path.isdir(directory()):
+        return []
+    return sorted(os.path.join(directory(), f) for f in os.listdir(directory()) if f.endswith(".db"))
+
+def shard_name(file_path: str):
+    return os.path.basename(file_path)
+
+ready: set[str] = set()
+init_locks: dict[str, asyncio.Lock] = {}
+
+async def ensure_guild_file(file_path: str):
+    # a shard file gets its tables the first time anything opens it
+    if file_path in ready:
+        return
+    async with init_locks.setdefault(file_path, asyncio.Lock()):
+        if file_path in ready:
+            return
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        async with aiosqlite.connect(file_path) as db:
+            await init_guild_tables(db)
+            await db.commit()
+        ready.add(file_path)
+
+@contextlib.asynccontextmanager
+async def connect_path(file_path: str):
+    if enabled() and file_path != shared_path():
+        await ensure_guild_file(file_path)
+    async with aiosqlite.connect(file_path) as db:
+        # handles whose global row needs recomputing once this connection's writes are committed
+        db.dirty_handles = set()
+        yield db
+        dirty = db.dirty_handles
+    if dirty and enabled():
+        global_queue.mark(file_path, dirty)
+
+def connect(server_id: int):
+    # async with shards.connect(server_id) as db: ... for anything that reads or writes users/challenges
+    return connect_path(guild_path(server_id))
+
+def connect_shared():
+    return aiosqlite.connect(shared_path())
+
+# util.global_handle_select per shard, with the sum instead of the average so parts can be added up
+part_select = """
+    SELECT handle, COUNT(*), MAX(rating), SUM(rating), SUM(solved_count), SUM(challenge_count) FROM users
+"""
+global_from_parts = """
+    SELECT handle, SUM(guilds), MAX(best_rating), SUM(rating_sum) * 1.0 / SUM(guilds), SUM(solved), SUM(challenges) FROM global_parts
+"""
+
+class GlobalQueue:
+    # (shard file, handle) pairs written within `window` seconds of each other are folded into
+    # global_parts and global_handles in one transaction on bot_data.db
+    def __init__(self):
+        self.pending: set[tuple[str, str]] = set()
+        self.scheduled = False
+        self.lock = asyncio.Lock()
+        self.tasks = set()
+
+    def mark(self, file_path: str, handles):
+        self.pending.update((file_path, h) for h in handles)
+        if not self.scheduled:
+            self.scheduled = True
+            task = asyncio.create_task(self.flush())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def flush(self):
+        await asyncio.sleep(global_window)
+        async with self.lock:
+            self.scheduled = False
+            batch, self.pending = self.pending, set()
+            try:
+                await self.write(batch)
+            except Exception as e:
+                logger.error(f"Database error (global handles for {len(batch)} handles): {e}")
+
+    @tracing.traced("db")
+    async def write(self, batch: set):
+        by_file: dict[str, list[str]] = {}
+        for file_path, handle in batch:
+            by_file.setdefault(file_path, []).append(handle)
+        parts = []
+        for file_path, handles in by_file.items():
+            async with aiosqlite.connect(file_path) as db:
+                for handle in handles:
+                    async with db.execute(f"{part_select} WHERE handle = ? GROUP BY handle", (handle,)) as cursor:
+                        row = await cursor.fetchone()
+                    parts.append((shard_name(file_path), handle, row))
+        async with connect_shared() as db:
+            await db.execute("BEGIN TRANSACTION")
+            for shard, handle, row in parts:
+                await db.execute("DELETE FROM global_parts WHERE handle = ? AND shard = ?", (handle, shard))
+                if row is not None:
+                    await db.execute("INSERT INTO global_parts VALUES (?, ?, ?, ?, ?, ?, ?)", (row[0], shard, *row[1:]))
+            for handle in {handle for _, handle, _ in parts}:
+                await db.execute("DELETE FROM global_handles WHERE handle = ?", (handle,))
+                await db.execute(f"INSERT INTO global_handles {global_from_parts} WHERE handle = ? GROUP BY handle", (handle,))
+            await db.commit()
+
+global_queue = GlobalQueue()
+
+async def init_guild_tables(db):
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        server_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        handle TEXT NOT NULL,
+        rating INTEGER NOT NULL,
+        history TEXT DEFAULT '[]',
+        rating_history TEXT DEFAULT '[]',
+        PRIMARY KEY (server_id, user_id)
+    );
+    """)
+    # one row per finished challenge, seq counts up from 0 per user so history pages are range reads
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS challenges (
+        server_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        problem TEXT NOT NULL,
+        rating_before INTEGER NOT NULL,
+        rating_after INTEGER NOT NULL,
+        length INTEGER,
+        time INTEGER,
+        PRIMARY KEY (server_id, user_id, seq)
+    );
+    """)
+    async with db.execute("PRAGMA table_info(users)") as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+    if "challenge_count" not in columns:
+        await db.execute("ALTER TABLE users ADD COLUMN challenge_count INTEGER NOT NULL DEFAULT 0")
+        await backfill_challenges(db)
+    if "solved_count" not in columns:
+        await db.execute("ALTER TABLE users ADD COLUMN solved_count INTEGER NOT NULL DEFAULT 0")
+        await db.execute("""
+        UPDATE users SET solved_count = (
+            SELECT COUNT(*) FROM challenges c
+            WHERE c.server_id = users.server_id AND c.user_id = users.user_id AND c.rating_after > c.rating_before
+        )
+        """)
+    await db.execute("CREATE INDEX IF NOT EXISTS users_handle ON users (handle)")
+
+async def backfill_challenges(db):
+    # users from before the challenges table, rebuild their rows from the json arrays
+    async with db.execute("SELECT server_id, user_id, history, rating_history FROM users") as cursor:
+        rows = await cursor.fetchall()
+    for server_id, user_id, history, rating_history in rows:
+        history = json.loads(history)
+        rating_history = json.loads(rating_history)
+        count = min(len(history), len(rating_history) - 1)
+        await db.executemany(
+            "INSERT OR REPLACE INTO challenges (server_id, user_id, seq, problem, rating_before, rating_after) VALUES (?, ?, ?, ?, ?, ?)",
+            [(server_id, user_id, k, history[k], rating_history[k], rating_history[k + 1]) for k in range(count)]
+        )
+        await db.execute("UPDATE users SET challenge_count = ? WHERE server_id = ? AND user_id = ?", (max(count, 0), server_id, user_id))
+    logger.info(f"Backfilled challenges for {len(rows)} users.")
+
+async def init_shared_tables(db):
+    # returns True if global_handles had to be created (and so needs filling)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS ac (
+        handle TEXT NOT NULL,
+        solved TEXT DEFAULT '[]',
+        last_sub INTEGER NOT NULL,
+        PRIMARY KEY (handle)
+    );
+    """)
+    # per handle aggregates over every server, kept up to date by refresh_global_handle
+    async with db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'global_handles'") as cursor:
+        has_global = await cursor.fetchone() is not None
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS global_handles (
+        handle TEXT NOT NULL,
+        guilds INTEGER NOT NULL,
+        best_rating INTEGER NOT NULL,
+        avg_rating REAL NOT NULL,
+        solved INTEGER NOT NULL,
+        challenges INTEGER NOT NULL,
+        PRIMARY KEY (handle)
+    );
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS global_best ON global_handles (best_rating DESC)")
+    await db.execute("CREATE INDEX IF NOT EXISTS global_avg ON global_handles (avg_rating DESC)")
+    await db.execute("CREATE INDEX IF NOT EXISTS global_solved ON global_handles (solved DESC)")
+    if enabled():
+        # each shard's share of a handle's global row
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS global_parts (
+            handle TEXT NOT NULL,
+            shard TEXT NOT NULL,
+            guilds INTEGER NOT NULL,
+            best_rating INTEGER NOT NULL,
+            rating_sum INTEGER NOT NULL,
+            solved INTEGER NOT NULL,
+            challenges INTEGER NOT NULL,
+            PRIMARY KEY (handle, shard)
+        );
+        """)
+    return not has_global
+
+async def init():
+    if not enabled():
+        async with aiosqlite.connect(shared_path()) as db:
+            await init_guild_tables(db)
+            fill = await init_shared_tables(db)
+            if fill:
+                await db.execute(f"INSERT INTO global_handles {util.global_handle_select} GROUP BY handle")
+            await db.commit()
+        return
+    async with connect_shared() as db:
+        fill = await init_shared_tables(db)
+        await db.commit()
+    # first start with shards on: move the guilds out of bot_data.db. Its users table is only
+    # renamed once everything is copied, so a split that didn't finish runs again on the next start
+    if await asyncio.to_thread(has_unsharded_users):
+        async with connect_shared() as db:
+            # a bot_data.db from before the challenges table and the counters needs them first
+            await init_guild_tables(db)
+            await db.commit()
+        await asyncio.to_thread(split)
+        fill = True
+    for file_path in guild_paths():
+        ready.discard(file_path)
+        await ensure_guild_file(file_path)
+    if fill:
+        await asyncio.to_thread(rebuild_global)
+
+# blocking helpers for startup and the command line tools (backup.py, replay_ratings.py)
+
+def has_unsharded_users():
+    conn = sqlite3.connect(shared_path())
+    try:
+        if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone() is None:
+            return False
+        return conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None
+    finally:
+        conn.close()
+
+def copy_table(src: sqlite3.Connection, dest: sqlite3.Connection, table: str, server_id: int):
+    if src.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is None:
+        return
+    cursor = src.execute(f"SELECT * FROM {table} WHERE server_id = ?", (server_id,))
+    names = [d[0] for d in cursor.description]
+    dest.executemany(f"INSERT OR REPLACE INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})", cursor)
+
+def split():
+    # copies every guild's users and challenges from bot_data.db into its shard, then renames the
+    # old tables (*_unsharded) so they are kept but no longer read
+    src = sqlite3.connect(shared_path())
+    try:
+        guilds = [g for (g,) in src.execute("SELECT DISTINCT server_id FROM users")]
+        files: dict[str, sqlite3.Connection] = {}
+        try:
+            for server_id in guilds:
+                file_path = guild_path(server_id)
+                if file_path not in files:
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    asyncio.run(create_guild_file(file_path))
+                    files[file_path] = sqlite3.connect(file_path)
+                copy_table(src, files[file_path], "users", server_id)
+                copy_table(src, files[file_path], "challenges", server_id)
+            for conn in files.values():
+                conn.commit()
+        finally:
+            for conn in files.values():
+                conn.close()
+        src.execute("ALTER TABLE users RENAME TO users_unsharded")
+        if src.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'challenges'").fetchone() is not None:
+            src.execute("ALTER TABLE challenges RENAME TO challenges_unsharded")
+        src.commit()
+        logger.info(f"Moved {len(guilds)} guilds into {len(files)} shard files.")
+    finally:
+        src.close()
+
+async def create_guild_file(file_path: str):
+    async with aiosqlite.connect(file_path) as db:
+        await init_guild_tables(db)
+        await db.commit()
+
+def rebuild_global():
+    # global_parts and global_handles from scratch, reading every shard
+    conn = sqlite3.connect(shared_path())
+    try:
+        conn.execute("BEGIN")
+        conn.execute("DELETE FROM global_parts")
+        for file_path in guild_paths():
+            shard = sqlite3.connect(file_path)
+            try:
+                rows = shard.execute(f"{part_select} GROUP BY handle").fetchall()
+            finally:
+                shard.close()
+            conn.executemany("INSERT INTO global_parts VALUES (?, ?, ?, ?, ?, ?, ?)", [(r[0], shard_name(file_path), *r[1:]) for r in rows])
+        conn.execute("DELETE FROM global_handles")
+        conn.execute(f"INSERT INTO global_handles {global_from_parts} GROUP BY handle")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
@@ -0,0 +1,173 @@
+import json
+import time
+import asyncio
+import logging
+import aiosqlite
+
+import config
+import shards
+import tracing
+from exceptions import DatabaseError, RequestError
+
+logger = logging.getLogger("bot_logger.solved")
+
+# handle -> when its solved set was last brought up to date (by =suggest or the prewarmer)
+refreshed: dict[str, float] = {}
+# handle -> id of the newest accepted submission we know of, changes only when the handle solves something
+solve_cursor: dict[str, int] = {}
+# (server_id, user_id) -> last command time, so active users get prewarmed first
+activity: dict[tuple[int, int], float] = {}
+
+prewarm_interval = config.get("prewarm_interval", 1800.0)
+# pause between handles, and while codeforces traffic is busy
+prewarm_pause = 2.0
+prewarm_busy_wait = 15.0
+
+def note_activity(server_id: int, user_id: int):
+    activity[(server_id, user_id)] = time.time()
+
+async def get_solved(egg, handle: str, priority: str = "interactive"):
+    ret = []
+    new_last = -1
+    async with shards.connect_shared() as db:
+        async with db.execute("SELECT * FROM ac WHERE handle = ?", (handle, )) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                logger.info("Small query.")
+                prev_last = row[2]
+                cur_list = json.loads(row[1])
+                try:
+                    subs = await egg.extract("submissions", "user.status", {"handle": handle, "from": 1, "count": 100}, priority=priority)
+
+                    found = False
+                    first = False
+                    newest_ok = None
+                    for sub_id, _, pid, verdict in subs:
+                        if not first:
+                            new_last = sub_id
+                            first = True
+                        if sub_id != prev_last:
+                            if verdict == "OK" and pid is not None:
+                                cur_list.append(pid)
+                                if newest_ok is None:
+                                    newest_ok = sub_id
+                        else:
+                            found = True
+                            logger.info("Small query worked.")
+                            ret = cur_list
+                            if newest_ok is not None:
+                                solve_cursor[handle] = newest_ok
+                            else:
+                                solve_cursor.setdefault(handle, prev_last)
+                            break
+
+                    if not found:
+                        nl = [0]
+                        await large_query(egg, handle, ret, nl, priority)
+                        new_last = nl[0]
+
+                except Exception as e:
+                    logger.error(f"Error when getting submissions: {e}")
+                    raise RequestError(e)
+
+            else:
+                logger.info("Large query.")
+                try:
+                    nl = [0]
+                    await large_query(egg, handle, ret, nl, priority)
+                    new_last = nl[0]
+
+                except Exception as e:
+                    logger.error(f"Error when getting submissions: {e}")
+                    raise RequestError(e)
+    # write to db
+    if new_last != -1:
+        ret = list(set(ret))
+        try:
+            with tracing.span("db", "save_solved"):
+                async with shards.connect_shared() as db:
+                    await db.execute("""
+                        INSERT OR REPLACE INTO ac (handle, solved, last_sub)
+                        VALUES (?, ?, ?)
+                    """, (handle, json.dumps(ret), new_last))
+                    await db.commit()
+        except aiosqlite.Error as e:
+            logger.error(f"Database error: {e}")
+            raise DatabaseError(e)
+    refreshed[handle] = time.time()
+    return ret
+
+async def get_ac(egg, handle: str, start: int, ret: list, priority: str = "interactive"):
+    try:
+        ret.append(await egg.extract("solved", "user.status", {"handle": handle, "from": start, "count": 5000}, priority=priority))
+    except Exception as e:
+        logger.error(f"Error when getting submissions: {e}")
+        raise RequestError(e)
+
+async def large_query(egg, handle: str, ret: list, new_last: list, priority: str = "interactive"):
+    pages = []
+    if priority == "background":
+        # one page at a time, so the prewarmer never holds more than one dispatcher
+        for k in range(4):
+            await get_ac(egg, handle, 1 + 5000 * k, pages, priority)
+    else:
+        tasks = [asyncio.create_task(get_ac(egg, handle, 1 + 5000 * k, pages, priority)) for k in range(4)]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    # newest accepted submission over all pages
+    new_last[0] = max(page["last"] for page in pages)[1]
+    solve_cursor[handle] = new_last[0]
+    for page in pages:
+        ret.extend(page["solved"])
+
+@tracing.traced("db")
+async def prewarm_order():
+    # every linked handle, most recently active (command or challenge, in any guild) first
+    try:
+        rows = []
+        for file_path in shards.guild_paths():
+            async with shards.connect_path(file_path) as db:
+                async with db.execute("""
+                    SELECT u.handle, u.server_id, u.user_id, MAX(c.time)
+                    FROM users u LEFT JOIN challenges c ON c.server_id = u.server_id AND c.user_id = u.user_id
+                    GROUP BY u.server_id, u.user_id
+                """) as cursor:
+                    rows.extend(await cursor.fetchall())
+    except Exception as e:
+        logger.error(f"Database error, prewarm_order(): {e}")
+        raise DatabaseError(e)
+    last_active = {}
+    for handle, server_id, user_id, chal_time in rows:
+        t = max(activity.get((server_id, user_id), 0), chal_time or 0)
+        last_active[handle] = max(last_active.get(handle, 0), t)
+    return sorted(last_active, key=lambda h: -last_active[h])
+
+async def has_spare_capacity(egg):
+    stats = await egg.stats()
+    if stats["queue_depth"] > 0 or stats["free_dispatchers"] == 0:
+        return False
+    return await egg.breaker_state("user.status") == "closed"
+
+async def prewarm_loop(egg):
+    # keeps the ac rows of linked handles current, so =suggest almost never has to do a large query
+    while True:
+        try:
+            for handle in await prewarm_order():
+                if time.time() - refreshed.get(handle, 0) < prewarm_interval:
+                    continue
+                while not await has_spare_capacity(egg):
+                    await asyncio.sleep(prewarm_busy_wait)
+                try:
+                    await get_solved(egg, handle, priority="background")
+                except Exception as e:
+                    # don't retry a broken handle every minute
+                    refreshed[handle] = time.time()
+                    logger.error(f"Error while prewarming {handle}: {e}")
+                await asyncio.sleep(prewarm_pause)
+        except Exception as e:
+            logger.error(f"Error during prewarm_loop(): {e}")
+        await asyncio.sleep(60)
@@ -0,0 +1,64 @@
+import sys
+import json
+import argparse
+from collections import defaultdict
+
+import config
+
+def percentile(values: list, q: float):
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, max(0, int(round(q * (len(values) - 1)))))
+    return values[k]
+
+def print_table(title: str, groups: dict):
+    print(title)
+    print(f"{'name':<40} {'count':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for name, values in sorted(groups.items(), key=lambda x: -len(x[1])):
+        values.sort()
+        print(f"{name:<40} {len(values):>7} {percentile(values, 0.5):>10.1f} {percentile(values, 0.95):>10.1f} {percentile(values, 0.99):>10.1f}")
+    print()
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize command traces written by tracing.py")
+    parser.add_argument("file", nargs="?", default=config.get("trace_path", config.path + "traces.jsonl"))
+    parser.add_argument("--command", help="only look at this command")
+    parser.add_argument("--names", action="store_true", help="also break spans down by name (endpoint, query, route)")
+    args = parser.parse_args()
+
+    commands = defaultdict(list)
+    kinds = defaultdict(list)
+    names = defaultdict(list)
+    # total time per (command, span kind) in one invocation
+    per_command_kind = defaultdict(list)
+
+    with open(args.file, encoding="utf-8") as f:
+        for line in f:
+            try:
+                trace = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if args.command and trace["command"] != args.command:
+                continue
+            commands[trace["command"]].append(trace["duration"])
+            totals = defaultdict(float)
+            for kind, name, _, duration, _ in trace["spans"]:
+                kinds[kind].append(duration)
+                names[f"{kind} {name}"].append(duration)
+                totals[kind] += duration
+            for kind, total in totals.items():
+                per_command_kind[f"{trace['command']} / {kind}"].append(total)
+
+    if not commands:
+        print("No traces.")
+        return 1
+
+    print_table("Per command (total ms)", commands)
+    print_table("Per span type (ms per span)", kinds)
+    print_table("Per command and span type (ms per invocation)", per_command_kind)
+    if args.names:
+        print_table("Per span name (ms per span)", names)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import functools
+import contextvars
+
+import config
+
+logger = logging.getLogger("bot_logger.tracing")
+
+sample_rate = config.get("trace_sample_rate", 0.1)
+trace_path = config.get("trace_path", config.path + "traces.jsonl")
+# a 80 minute challenge makes a lot of spans, don't keep more than this per trace
+max_spans = 2000
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    def __init__(self, command: str, guild):
+        self.command = command
+        self.guild = guild
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+
+class span:
+    # with tracing.span("db", "get_rating"): ... (works around awaits too)
+    __slots__ = ("kind", "name", "trace", "start")
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self):
+        self.trace = current_trace.get()
+        if self.trace is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self.trace
+        if trace is None:
+            return False
+        if len(trace.spans) >= max_spans:
+            trace.dropped += 1
+            return False
+        end = time.perf_counter()
+        trace.spans.append([self.kind, self.name, round((self.start - trace.start) * 1000, 3), round((end - self.start) * 1000, 3), exc_type is None])
+        return False
+
+def traced(kind: str):
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(kind, fn.__name__):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class TraceWriter:
+    # the file is written from a thread so the event loop never waits on disk
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+
+    def put(self, line: str):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="trace-writer", daemon=True)
+            self.thread.start()
+        self.queue.put(line)
+
+    def run(self):
+        while True:
+            lines = [self.queue.get()]
+            while not self.queue.empty():
+                lines.append(self.queue.get())
+            try:
+                with open(self.file_path, "a", encoding="utf-8") as f:
+                    f.write("".join(lines))
+            except Exception as e:
+                logger.error(f"Failed to write traces: {e}")
+
+writer = TraceWriter(trace_path)
+
+def start_trace(command: str, guild):
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        return None
+    trace = Trace(command, guild)
+    current_trace.set(trace)
+    return trace
+
+def finish_trace(error: bool = False):
+    trace = current_trace.get()
+    if trace is None:
+        return
+    current_trace.set(None)
+    record = {
+        "command": trace.command,
+        "guild": trace.guild,
+        "time": trace.wall,
+        "duration": round((time.perf_counter() - trace.start) * 1000, 3),
+        "error": error,
+        "spans": trace.spans,
+        "dropped": trace.dropped
+    }
+    writer.put(json.dumps(record, separators=(",", ":")) + "\n")
+
+def instrument_http(http):
+    # every discord REST call (fetch_message, fetch_member, edit, send, ...) goes through HTTPClient.request
+    request = http.request
+
+    async def traced_request(route, **kwargs):
+        with span("discord", f"{route.method} {route.path}"):
+            return await request(route, **kwargs)
+
+    http.request = traced_request
@@ -1,44 +1,203 @@
+import sys
 import json
 import discord
-import aiosqlite
 import asyncio
 import logging
+import shards
+import tracing
+from proxy import CircuitOpen, Overloaded
+from array import array
 from exceptions import DatabaseError, RequestError
 from pathlib import Path
 
-logger = logging.getLogger("bot_logger")
+logger = logging.getLogger("bot_logger.util")
 path = str(Path(__file__).parent) + "/"
 
-problems = None
-problem_dict = None
 initialized = False
 
+# bumped on every refresh that changes something, problem_changes has (version, kind, problem id)
+# for everything after problem_log_start, kind is one of "new", "rated", "changed", "removed"
+problems_version = 0
+problem_log_start = 0
+problem_changes = []
+max_problem_changes = 5000
+# every problem id we have seen, rated or not, to tell new problems from newly rated ones
+seen_problems = set()
+# called with the list of changes after every refresh that changed something (and the first load)
+problem_listeners = []
+
+class Problem:
+    # one catalog row, made when someone asks for it
+    __slots__ = ("id", "contest_id", "index", "name", "rating", "tags")
+
+    def __init__(self, id: str, contest_id: int, index: str, name: str, rating: int, tags: list):
+        self.id = id
+        self.contest_id = contest_id
+        self.index = index
+        self.name = name
+        self.rating = rating
+        self.tags = tags
+
+    @property
+    def url(self):
+        return f"https://codeforces.com/problemset/problem/{self.contest_id}/{self.index}"
+
+class ProblemCatalog:
+    # the rated problems as columns instead of one dict per problem: row i is ids[i],
+    # contest_ids[i], indexes[i], ratings[i], the utf-8 name between name_ends[i - 1] and
+    # name_ends[i], and the tag ids between tag_ends[i - 1] and tag_ends[i]. rows maps id -> row
+    def __init__(self, problems: list):
+        self.ids: list[str] = []
+        self.rows: dict[str, int] = {}
+        self.contest_ids = array("i")
+        # interned, there are only a few dozen different ones
+        self.indexes: list[str] = []
+        self.ratings = array("H")
+        self.name_ends = array("I")
+        self.tag_names: list[str] = []
+        self.tag_ids: dict[str, int] = {}
+        self.tag_data = array("B")
+        self.tag_ends = array("I")
+        names = bytearray()
+        for p in problems:
+            pid = str(p["contestId"]) + p["index"]
+            if pid in self.rows:
+                continue
+            self.rows[pid] = len(self.ids)
+            self.ids.append(pid)
+            self.contest_ids.append(p["contestId"])
+            self.indexes.append(sys.intern(p["index"]))
+            self.ratings.append(p["rating"])
+            names += p["name"].encode()
+            self.name_ends.append(len(names))
+            for tag in p["tags"]:
+                if tag not in self.tag_ids:
+                    self.tag_ids[tag] = len(self.tag_names)
+                    self.tag_names.append(tag)
+                self.tag_data.append(self.tag_ids[tag])
+            self.tag_ends.append(len(self.tag_data))
+        self.names = bytes(names)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, pid: str):
+        return pid in self.rows
+
+    def __getitem__(self, pid: str) -> Problem:
+        return self.at(self.rows[pid])
+
+    def get(self, pid: str):
+        row = self.rows.get(pid)
+        return None if row is None else self.at(row)
+
+    def rating(self, pid: str) -> int:
+        return self.ratings[self.rows[pid]]
+
+    def contest_id(self, pid: str) -> int:
+        return self.contest_ids[self.rows[pid]]
+
+    def name_of(self, row: int) -> str:
+        return self.names[self.name_ends[row - 1] if row else 0:self.name_ends[row]].decode()
+
+    def tag_ids_of(self, row: int):
+        return self.tag_data[self.tag_ends[row - 1] if row else 0:self.tag_ends[row]]
+
+    def tags_of(self, row: int) -> list:
+        return [self.tag_names[t] for t in self.tag_ids_of(row)]
+
+    def at(self, row: int) -> Problem:
+        return Problem(self.ids[row], self.contest_ids[row], self.indexes[row], self.name_of(row), self.ratings[row], self.tags_of(row))
+
+    def as_dict(self, row: int) -> dict:
+        # the extract_problems shape, to carry a row over into the next catalog
+        return {"contestId": self.contest_ids[row], "index": self.indexes[row], "name": self.name_of(row), "rating": self.ratings[row], "tags": self.tags_of(row)}
+
+    def same(self, row: int, p: dict):
+        return (self.contest_ids[row] == p["contestId"] and self.indexes[row] == p["index"] and self.ratings[row] == p["rating"]
+                and self.name_of(row) == p["name"] and self.tags_of(row) == list(p["tags"]))
+
+# None until the first refresh
+catalog: ProblemCatalog = None
+
+def changes_since(version: int):
+    # None means the log doesn't go back that far and everything should be treated as changed
+    if version < problem_log_start:
+        return None
+    return [c for c in problem_changes if c[0] > version]
+
+def apply_problems(new_problems: list):
+    global catalog
+    global problems_version
+    global problem_log_start
+    if catalog is None:
+        catalog = ProblemCatalog([p for p in new_problems if p["rating"] is not None])
+        seen_problems.update(str(p["contestId"]) + p["index"] for p in new_problems)
+        problems_version += 1
+        problem_log_start = problems_version
+        notify_problem_listeners([])
+        return []
+
+    changes = []
+    current = set()
+    rated = []
+    for p in new_problems:
+        pid = str(p["contestId"]) + p["index"]
+        current.add(pid)
+        row = catalog.rows.get(pid)
+        if p["rating"] is None:
+            seen_problems.add(pid)
+            # a problem that loses its rating keeps the old one
+            if row is not None:
+                rated.append(catalog.as_dict(row))
+            continue
+        rated.append(p)
+        if row is None:
+            changes.append(("rated" if pid in seen_problems else "new", pid))
+            seen_problems.add(pid)
+        elif not catalog.same(row, p):
+            changes.append(("changed", pid))
+    changes.extend(("removed", pid) for pid in catalog.ids if pid not in current)
+
+    if changes:
+        # columns don't take inserts, so a refresh that changes anything builds a new catalog
+        catalog = ProblemCatalog(rated)
+        problems_version += 1
+        problem_changes.extend((problems_version, kind, pid) for kind, pid in changes)
+        if len(problem_changes) > max_problem_changes:
+            del problem_changes[:len(problem_changes) - max_problem_changes]
+            problem_log_start = problem_changes[0][0]
+        notify_problem_listeners(changes)
+    return changes
+
+def notify_problem_listeners(changes: list):
+    for listener in problem_listeners:
+        try:
+            listener(changes)
+        except Exception as e:
+            logger.error(f"Error in problem listener: {e}")
+
 async def get_problems(egg):
-    global problems
-    global problem_dict
     logger.info("Getting problems...")
-    response_data = await egg.codeforces("problemset.problems")
-    logger.info("Got problems.")
-    if response_data["status"] != "OK":
-        return
-    problems = response_data["result"]["problems"]
-    problems = [obj for obj in problems if "rating" in obj and not "*special" in obj["tags"]]
-    problem_dict = {}
-    for problem in problems:
-        problem_dict[str(problem["contestId"]) + problem["index"]] = problem
+    new_problems = await egg.extract("problems", "problemset.problems", priority="background")
+    changes = apply_problems(new_problems)
+    logger.info(f"Got problems ({len(changes)} changes, version {problems_version}).")
 
+@tracing.traced("db")
 async def fix_handles(egg):
     try:
-        async with aiosqlite.connect(path + "bot_data.db") as db:
-            async with db.execute("SELECT handle FROM users") as cursor:
-                rows = await cursor.fetchall()
-                await fix(egg, [row[0] for row in rows])
+        handles = set()
+        for file_path in shards.guild_paths():
+            async with shards.connect_path(file_path) as db:
+                async with db.execute("SELECT handle FROM users") as cursor:
+                    handles.update(row[0] for row in await cursor.fetchall())
+        await fix(egg, list(handles))
     except Exception as e:
         logger.error(f"Database error, fix_handles(): {e}")
 
 async def get_new_handle(egg, handle):
     try:
-        response_data = await egg.codeforces("user.info", {"handles": handle})
+        response_data = await egg.codeforces("user.info", {"handles": handle}, priority="background")
         if response_data["status"] != "OK":
             return handle
         return response_data["result"][0]["handle"]
@@ -49,15 +208,19 @@ async def get_new_handle(egg, handle):
         return handle
 
 async def fix(egg, handles):
-    logger.info(handles)
+    logger.info(f"Checking {len(handles)} handles for renames")
     try:
-        async with aiosqlite.connect(path + "bot_data.db") as db:
-            for handle in handles:
-                new_handle = await get_new_handle(egg, handle)
-                if new_handle != handle:
-                    logger.info(f"Change from {handle} to {new_handle}.")
-                    await db.execute("UPDATE users SET handle = ? WHERE handle = ?", (new_handle, handle))
-                    await db.commit()
+        for handle in handles:
+            new_handle = await get_new_handle(egg, handle)
+            if new_handle != handle:
+                logger.info(f"Change from {handle} to {new_handle}.")
+                # a handle can be linked in guilds on several shards
+                for file_path in shards.guild_paths():
+                    async with shards.connect_path(file_path) as db:
+                        await db.execute("UPDATE users SET handle = ? WHERE handle = ?", (new_handle, handle))
+                        await refresh_global_handle(db, handle)
+                        await refresh_global_handle(db, new_handle)
+                        await db.commit()
     except Exception as e:
         logger.error(f"Database error, fix(): {e}")
 
@@ -100,20 +263,21 @@ async def parse_data(egg):
 
         await asyncio.sleep(3600)
 
-async def handle_exists_on_cf(egg, handle: str):
+async def handle_exists_on_cf(egg, handle: str, budget: float = None, hedge: bool = False):
     for c in handle:
         if not (c.isalpha() or (c >= '0' and c <= '9') or c == '_' or c == '-' or c == '.'):
             return False
     try:
-        response_data = await egg.codeforces("user.info", {"handles": handle})
+        response_data = await egg.codeforces("user.info", {"handles": handle}, hedge=hedge, budget=budget)
         return response_data["status"] == "OK" and response_data["result"][0]["handle"].lower() == handle.lower()
     except Exception as e:
         logger.error(f"Request error, handle_exists_on_cf(): {e}")
         raise RequestError(e)
 
+@tracing.traced("db")
 async def handle_exists(server_id: int, user_id: int, handle: str):
     try:
-        async with aiosqlite.connect(path + "bot_data.db") as db:
+        async with shards.connect(server_id) as db:
             async with db.execute("SELECT user_id FROM users WHERE server_id = ? AND handle = ?", (server_id, handle)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -123,9 +287,10 @@ async def handle_exists(server_id: int, user_id: int, handle: str):
         logger.error(f"Database error, handle_exists(): {e}")
         raise DatabaseError(e)
 
+@tracing.traced("db")
 async def handle_linked(server_id: int, user_id: int):
     try:
-        async with aiosqlite.connect(path + "bot_data.db") as db:
+        async with shards.connect(server_id) as db:
             async with db.execute("SELECT handle FROM users WHERE server_id = ? AND user_id = ?", (server_id, user_id)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -135,9 +300,10 @@ async def handle_linked(server_id: int, user_id: int):
         logger.error(f"Database error, handle_linked(): {e}")
         raise DatabaseError(e)
 
+@tracing.traced("db")
 async def get_handle(server_id: int, user_id: int):
     try:
-        async with aiosqlite.connect(path + "bot_data.db") as db:
+        async with shards.connect(server_id) as db:
             async with db.execute("SELECT handle FROM users WHERE server_id = ? AND user_id = ?", (server_id, user_id)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -147,6 +313,7 @@ async def get_handle(server_id: int, user_id: int):
         logger.error(f"Database error, get_handle(): {e}")
         raise DatabaseError(e)
 
+# replay_ratings.get_rating_changes_np is the same formula over arrays, keep the two in sync
 def get_rating_changes(old_rating: int, problem_rating: int, length: int):
     # adjust for length
     problem_rating += 50 * ((80 - length) / 20)
@@ -155,9 +322,10 @@ def get_rating_changes(old_rating: int, problem_rating: int, length: int):
     return [int(-min(magnitude * 10, (0.5 * magnitude) // (1 - (1 / (1 + 10 ** ((problem_rating - old_rating) / 500)))))), 
             int(min(magnitude * 10, (0.5 * magnitude) // (1.15 / (1 + 10 ** ((problem_rating - old_rating) / 500)))))]
 
+@tracing.traced("db")
 async def get_rating(server_id: int, user_id: int):
     try:
-        async with aiosqlite.connect(path + "bot_data.db") as db:
+        async with shards.connect(server_id) as db:
             async with db.execute("SELECT rating FROM users WHERE server_id = ? AND user_id = ?", (server_id, user_id)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -167,9 +335,10 @@ async def get_rating(server_id: int, user_id: int):
         logger.error(f"Database error, get_rating(): {e}")
         raise DatabaseError(e)
 
+@tracing.traced("db")
 async def get_history(server_id: int, user_id: int):
     try:
-        async with aiosqlite.connect(path + "bot_data.db") as db:
+        async with shards.connect(server_id) as db:
             async with db.execute("SELECT history FROM users WHERE server_id = ? AND user_id = ?", (server_id, user_id)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -179,9 +348,10 @@ async def get_history(server_id: int, user_id: int):
         logger.error(f"Database error, get_history(): {e}")
         raise DatabaseError(e)
 
+@tracing.traced("db")
 async def get_rating_history(server_id: int, user_id: int):
     try:
-        async with aiosqlite.connect(path + "bot_data.db") as db:
+        async with shards.connect(server_id) as db:
             async with db.execute("SELECT rating_history FROM users WHERE server_id = ? AND user_id = ?", (server_id, user_id)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -191,28 +361,70 @@ async def get_rating_history(server_id: int, user_id: int):
         logger.error(f"Database error, get_rating_history(): {e}")
         raise DatabaseError(e)
 
+async def busy_message(egg, endpoint: str, priority: str = "interactive"):
+    # None if a command of this priority can go ahead, otherwise what to tell the user
+    try:
+        await egg.admit(priority, endpoint=endpoint)
+        return None
+    except Overloaded as e:
+        return f"Codeforces is busy right now, try again in about {max(1, round(e.eta))} seconds."
+    except CircuitOpen as e:
+        return f"Codeforces seems to be down, try again in about {max(1, round(e.retry_in))} seconds."
+
 def format_time(seconds: float):
     minutes, seconds = divmod(int(seconds), 60)
     return f"{minutes}:{seconds:02d}"
 
-async def get_leaderboard(server_id: int):
+global_handle_select = """
+    SELECT handle, COUNT(*), MAX(rating), AVG(rating), SUM(solved_count), SUM(challenge_count) FROM users
+"""
+
+async def refresh_global_handle(db, handle: str):
+    # recompute one handle's row from its (few) users rows, run inside the caller's transaction.
+    # With db_shards the rows are spread over files, so it's queued until db (from shards.connect) closes
+    if shards.enabled():
+        db.dirty_handles.add(handle)
+        return
+    await db.execute("DELETE FROM global_handles WHERE handle = ?", (handle,))
+    await db.execute(f"INSERT INTO global_handles {global_handle_select} WHERE handle = ? GROUP BY handle", (handle,))
+
+global_orders = {
+    "best": "best_rating",
+    "avg": "avg_rating",
+    "solved": "solved"
+}
+
+@tracing.traced("db")
+async def get_global_page(order: str, page: int, per_page: int = 10):
     try:
-        async with aiosqlite.connect(path + "bot_data.db") as db:
-            async with db.execute("SELECT user_id, rating FROM users WHERE server_id = ? ORDER BY rating DESC", (server_id,)) as cursor:
-                rows = await cursor.fetchall()
-                return rows
+        async with shards.connect_shared() as db:
+            async with db.execute(
+                f"SELECT handle, guilds, best_rating, avg_rating, solved, challenges FROM global_handles ORDER BY {global_orders[order]} DESC LIMIT ? OFFSET ?",
+                (per_page, (page - 1) * per_page)
+            ) as cursor:
+                return await cursor.fetchall()
     except Exception as e:
-        logger.error(f"Database error, get_leaderboard(): {e}")
-        return None
+        logger.error(f"Database error, get_global_page(): {e}")
+        raise DatabaseError(e)
 
-async def get_history_with_rating_history(server_id: int, user_id: int):
+@tracing.traced("db")
+async def get_history_page(server_id: int, user_id: int, page: int, per_page: int = 10):
+    # [challenge count, [(problem, rating before, rating after)] newest first] or None if not linked
     try:
-        async with aiosqlite.connect(path + "bot_data.db") as db:
-            async with db.execute("SELECT history, rating_history FROM users WHERE server_id = ? AND user_id = ?", (server_id, user_id)) as cursor:
+        async with shards.connect(server_id) as db:
+            async with db.execute("SELECT challenge_count FROM users WHERE server_id = ? AND user_id = ?", (server_id, user_id)) as cursor:
                 row = await cursor.fetchone()
-                if row:
-                    return [json.loads(row[0]), json.loads(row[1])]
-                return None
+                if not row:
+                    return None
+                count = row[0]
+            # seq runs 0..count-1, so a page is a range on the primary key
+            hi = count - 1 - (page - 1) * per_page
+            async with db.execute(
+                "SELECT problem, rating_before, rating_after FROM challenges WHERE server_id = ? AND user_id = ? AND seq BETWEEN ? AND ? ORDER BY seq DESC",
+                (server_id, user_id, hi - per_page + 1, hi)
+            ) as cursor:
+                rows = await cursor.fetchall()
+                return [count, rows]
     except Exception as e:
-        logger.error(f"Database error, get_history_with_rating_history(): {e}")
-        raise DatabaseError(e)
\ No newline at end of file
+        logger.error(f"Database error, get_history_page(): {e}")
+        raise DatabaseError(e)